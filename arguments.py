@@ -5,6 +5,7 @@ from tools.parameters import param, parse_args, choice, parse_choice, group
 from tools import struct
 
 import detection.models as models
+from models.common import checkpoint_modes
 
 train_parameters = struct (
     optimizer = group('optimizer settings',
@@ -27,6 +28,11 @@ train_parameters = struct (
 
     seed            = param(1,      help='random seed'),
     batch_size      = param(8,     help='input batch size for training'),
+    test_batch_size = param(1,     help='batch size for evaluation (and tiles of split images), only images of equal size are batched together'),
+    amp             = param('none', help='mixed precision training (none | fp16 | bf16), fp16 uses a gradient scaler'),
+    micro_batch     = param(None, type='int', help='split each batch into micro batches of this many images and accumulate gradients'),
+    checkpoint      = param('none', help='activation checkpointing to save memory in training (' + ' | '.join(checkpoint_modes) + 
+        '), recompute per pyramid level or per residual block (batch norm statistics are restored after recomputing)'),
 
     reviews      = param(0,     help = 'number of reviews conducted per epoch'),
     detections   = param(0,     help = 'number of detections conducted per epoch on new images'),
@@ -53,6 +59,7 @@ train_parameters = struct (
 
     paused          = param(False, help='start trainer paused'),
     num_workers     = param(4,      help='number of workers used to process dataset'),
+    encode_workers  = param(False,  help='(retina) match anchor boxes in the data loader workers rather than in the training step'),
     model           = choice(default='retina', options=models.parameters, help='model type and parameters e.g. "retina --start=4"'),
 
     bn_momentum    = param(0.9, "momentum for batch normalisation modules"),
@@ -81,7 +88,7 @@ detection_parameters = struct (
         train_size      = param(600,   help='size of patches to train on'),
 
         border_bias     = param(0.1,    help = "bias random crop to select border more often (proportion of size)"),
-        augment = param("crop", help = 'image augmentation method (crop | full | ssd)'),
+        augment = param("crop", help = 'image augmentation method (crop | resize | batched), batched performs augmentation on the training device'),
 
         scale  = param(1.0,     help='base scale of train_size'),
         resize = param(None, type='float', help='resize short side of images to this dimension'),
@@ -94,14 +101,23 @@ detection_parameters = struct (
         transposes  = param(False, help='enable image transposes in training'),
         flips          = param(True, help='enable horizontal image flips in training'),
         vertical_flips = param(False, help='enable vertical image flips in training'),
-        image_samples   = param(1,      help='number of training samples to extract from each loaded image')
+        image_samples   = param(1,      help='number of training samples to extract from each loaded image'),
+
+        image_cache = param(0, help='size (MB) of decoded image cache shared between workers and epochs (0 = disabled)'),
+        cache_dir   = param('/dev/shm/detection', help='directory for the decoded image cache (shared memory by default)')
     ),
 
 
     nms = group('nms',
         nms_threshold    = param (0.5, help = "overlap threshold (iou) used in nms to filter duplicates"),
         class_threshold  = param (0.05, help = 'hard threshold used to filter negative boxes'),
-        max_detections    = param (100,  help = 'maximum number of detections (for efficiency) in testing')
+        max_detections    = param (100,  help = 'maximum number of detections (for efficiency) in testing'),
+
+        nms_candidates   = param (1000, help = 'number of top candidates per pyramid level decoded before nms'),
+        nms_per_class    = param (False, help = 'apply nms within each class rather than over all classes'),
+
+        nms_method       = param ('hard', help = 'nms method (hard | soft | matrix), soft and matrix decay scores of overlapping boxes'),
+        nms_sigma        = param (0.5, help = 'gaussian decay parameter for soft and matrix nms')
     ),
 
     select_instance = param(0.5, help = 'probability of cropping around an object instance as opposed to a random patch'),
@@ -126,7 +142,9 @@ input_choices = struct(
     voc = struct(
         path          = param("/home/oliver/storage/voc", help = "path to exported json annotation file"),
         preset        = param("test2007", help='preset configuration of testing/training set used options test2007|val2012')
-    )
+    ),
+    packed = struct(
+        path          = param(type="str", help = "path to packed dataset file (see pack_dataset.py)", required=True))
 )
 
 def make_input_parameters(default = None, choices = input_choices):
@@ -0,0 +1,83 @@
+import torch
+
+from tools import struct
+from tools.parameters import param, parse_args
+
+from models.feature_pyramid import feature_pyramid, residual_subnet
+from models.common import set_checkpointing, checkpoint_modes
+
+from time import time
+
+parameters = struct (
+    backbone = param("resnet18", help = "name of pretrained model to use as backbone"),
+    features = param(64, help = "fixed size features in new conv layers"),
+    first = param(3, help = "first layer of feature maps, scale = 1 / 2^first"),
+    depth = param(8, help = "depth in scale levels"),
+
+    sizes = param('256,512,768,1024', help = "comma separated list of (square) train_size to measure"),
+    batch = param(8, help = "batch size"),
+
+    cpu = param(False, help = "run on the cpu even if cuda is available, reports memory saved for backward")
+)
+
+args = parse_args(parameters, "activation checkpointing memory benchmark", "parameters")
+print(args)
+
+device = torch.device('cpu') if args.cpu or not torch.cuda.is_available() else torch.cuda.current_device()
+
+
+class Model(torch.nn.Module):
+    """ Feature pyramid with a residual head on each level (as used by the detection models) """
+    def __init__(self):
+        super().__init__()
+
+        self.pyramid = feature_pyramid(args.backbone, first=args.first, depth=args.depth, features=args.features)
+        self.head = residual_subnet(args.features, 4)
+
+    def forward(self, input):
+        return [self.head(layer) for layer in self.pyramid(input)]
+
+
+def saved_bytes(f):
+    """ Total size of tensors saved for backward while running f (unique storages) """
+    storages = {}
+    def pack(t):
+        storage = t.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda t: t):
+        result = f()
+
+    return result, sum(storages.values())
+
+
+def measure(model, size):
+    input = torch.randn(args.batch, 3, size, size, device=device)
+    model.zero_grad()
+
+    if device != torch.device('cpu'):
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time()
+    outputs, saved = saved_bytes(lambda: model(input))
+    sum(output.mean() for output in outputs).backward()
+
+    if device != torch.device('cpu'):
+        torch.cuda.synchronize()
+        return struct(peak = torch.cuda.max_memory_allocated(), saved = saved, time = time() - start)
+
+    return struct(peak = None, saved = saved, time = time() - start)
+
+
+model = Model().to(device).train()
+mb = 1 << 20
+
+for size in map(int, args.sizes.split(",")):
+    for mode in checkpoint_modes:
+        set_checkpointing(model, mode)
+        r = measure(model, size)
+
+        peak = "" if r.peak is None else "peak {:.1f} MB, ".format(r.peak / mb)
+        print("train_size {} {}: {}saved activations {:.1f} MB, step {:.2f}s".format(size, mode, peak, r.saved / mb, r.time))
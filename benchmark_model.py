@@ -9,7 +9,7 @@ from tools.parameters import param, parse_args
 from tools.image import cv
 from main import load_model
 
-from evaluate import evaluate_image
+from evaluate import evaluate_image, evaluate_batch
 from detection import box, display, detection_table
 
 from dataset.annotate import tagged
@@ -95,4 +95,9 @@ for image in images:
 
 print_timer("evaluate_image", len(images), start)
 
-        
\ No newline at end of file
+start = time()
+
+for i in range(0, len(images), args.batch):
+    detections = evaluate_batch(model, images[i:i + args.batch], encoder, nms_params = nms_params, device=device).detections
+
+print_timer("evaluate_batch", len(images), start)
@@ -0,0 +1,62 @@
+import torch
+
+from tools import struct, table
+from tools.parameters import param, parse_args
+
+from detection import detection_table
+
+from time import time
+
+parameters = struct (
+    counts = param('100,1000,5000,20000', help = "comma separated numbers of detections per image"),
+    batch = param(8, help = "number of images per batch"),
+    classes = param(20, help = "number of classes"),
+
+    image_size = param(1024, help = "size of (square) image the boxes are placed in"),
+    iterations = param(20, help = "number of timed iterations for each method"),
+
+    cpu = param(False, help = "run on the cpu even if cuda is available")
+)
+
+args = parse_args(parameters, "nms benchmark", "parameters")
+print(args)
+
+device = torch.device('cpu') if args.cpu or not torch.cuda.is_available() else torch.cuda.current_device()
+
+
+def random_detections(n):
+    centre = torch.rand(n, 2, device=device) * args.image_size
+    size = torch.rand(n, 2, device=device) * args.image_size * 0.1 + 4
+
+    return table(
+        bbox = torch.cat([centre - size / 2, centre + size / 2], 1),
+        confidence = torch.rand(n, device=device),
+        label = torch.randint(0, args.classes, (n,), device=device))
+
+
+def synchronize():
+    if device != torch.device('cpu'):
+        torch.cuda.synchronize()
+
+
+def print_timer(desc, n, start):
+    elapsed = (time() - start) / args.iterations
+    print("{}: {} detections x {} images in {:.2f} ms".format(desc, n, args.batch, elapsed * 1000))
+
+
+for n in map(int, args.counts.split(",")):
+    prediction = random_detections(n * args.batch)
+
+    for method in detection_table.nms_methods:
+        for per_class in [False, True]:
+            params = detection_table.nms_defaults._extend(method = method, per_class = per_class)
+
+            detection_table.nms_batch(prediction, args.batch, params)
+            synchronize()
+
+            start = time()
+            for i in range(args.iterations):
+                detection_table.nms_batch(prediction, args.batch, params)
+
+            synchronize()
+            print_timer("{}{}".format(method, " (per class)" if per_class else ""), n, start)
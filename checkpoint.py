@@ -55,10 +55,11 @@ def load_state(model, info, strict=True):
 
     return struct(model = model, 
         thresholds=info.thresholds if 'thresholds' in info else None, 
+        scaler=info.scaler if 'scaler' in info else None,
         score = info.score, epoch = info.epoch)
 
 def new_state(model):
-    return struct (model = model, score = 0.0, epoch = 0, thresholds = None)
+    return struct (model = model, score = 0.0, epoch = 0, thresholds = None, scaler = None)
 
 def try_load(model_path):
     try:
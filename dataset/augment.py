@@ -0,0 +1,175 @@
+import math
+
+import torch
+import torch.nn.functional as F
+
+from tools import struct, split_table, tensors_to
+
+from detection import box
+
+
+def uniform(n, magnitude, device):
+    return (torch.rand(n, device=device) * 2 - 1) * magnitude
+
+def random_flags(n, enabled, device):
+    return torch.rand(n, device=device).lt(0.5) if enabled else torch.zeros(n, dtype=torch.bool, device=device)
+
+
+def matrices(*entries):
+    """ Batch of 3x3 matrices [B,3,3] from 9 entries (row major) of size [B] each """
+    return torch.stack(entries, 1).view(-1, 3, 3)
+
+def affine(a, b, c, d, e, f):
+    zero, one = torch.zeros_like(a), torch.ones_like(a)
+    return matrices(a, b, c, d, e, f, zero, zero, one)
+
+def select(flags, m):
+    eye = torch.eye(3, device=m.device).expand_as(m)
+    return torch.where(flags.view(-1, 1, 1), m, eye)
+
+
+def flip_matrices(flags, dest_size):
+    """ Pixel coordinate transforms of output -> input for transposes, vertical and horizontal flips,
+        composed in the same order as dataset.detection.random_flips """
+    w, h = dest_size
+    n = flags.transpose.size(0)
+
+    zero, one = torch.zeros(n, device=flags.transpose.device), torch.ones(n, device=flags.transpose.device)
+
+    transpose = select(flags.transpose, affine(zero, one, zero, one, zero, zero))
+    vertical = select(flags.vertical, affine(one, zero, zero, zero, -one, one * h))
+    horizontal = select(flags.horizontal, affine(-one, zero, one * w, zero, one, zero))
+
+    return transpose.bmm(vertical).bmm(horizontal)
+
+
+def sample_grid(offset, scale, flags, dest_size, canvas_size):
+    """ Sampling grid for F.grid_sample mapping the destination image to the canvas (align_corners=False) """
+    w, h = dest_size
+    cw, ch = canvas_size
+    n = offset.size(0)
+
+    one, zero = torch.ones(n, device=offset.device), torch.zeros(n, device=offset.device)
+
+    from_normalized = affine(one * w / 2, zero, one * w / 2, zero, one * h / 2, one * h / 2)
+    to_normalized = affine(one * 2 / cw, zero, -one, zero, one * 2 / ch, -one)
+
+    region = affine(1 / scale[:, 0], zero, offset[:, 0], zero, 1 / scale[:, 1], offset[:, 1])
+    m = to_normalized.bmm(region).bmm(flip_matrices(flags, dest_size)).bmm(from_normalized)
+
+    return F.affine_grid(m[:, :2], [n, 3, h, w], align_corners=False)
+
+
+def transform_boxes(bbox, index, offset, scale, flags, dest_size):
+    """ Boxes (of all images concatenated, index gives the image) from canvas to destination image,
+        using the same box transforms as the cpu augmentation """
+    w, h = dest_size
+    bbox = box.transform(bbox, -offset[index], scale[index])
+
+    def where(flag, flipped):
+        return torch.where(flag[index].unsqueeze(1), flipped, bbox)
+
+    bbox = where(flags.transpose, box.transpose(bbox))
+    bbox = where(flags.vertical, box.flip_vertical(bbox, h))
+    bbox = where(flags.horizontal, box.flip_horizontal(bbox, w))
+
+    return bbox
+
+
+def adjust_gamma(images, gamma, channel_gamma):
+    b, c = images.size(0), images.size(1)
+    device = images.device
+
+    g = uniform(b, gamma, device).view(b, 1, 1, 1) + uniform(b * c, channel_gamma, device).view(b, c, 1, 1)
+    return images.clamp(min=0).pow(torch.exp(g))
+
+def adjust_brightness(images, brightness, contrast):
+    b = images.size(0)
+
+    c = 1 + uniform(b, contrast, images.device).view(b, 1, 1, 1)
+    return images.mul(c).add(uniform(b, brightness, images.device).view(b, 1, 1, 1))
+
+
+rgb_to_yiq = torch.tensor([
+    [0.299,  0.587,  0.114],
+    [0.596, -0.274, -0.322],
+    [0.211, -0.523,  0.312]])
+
+def adjust_colours(images, hue, saturation):
+    """ Rotate hue and scale saturation in YIQ space """
+    if hue == 0 and saturation == 0:
+        return images
+
+    b = images.size(0)
+    device = images.device
+
+    angle = uniform(b, hue * math.pi * 2, device)
+    s = 1 + uniform(b, saturation, device)
+
+    zero, one = torch.zeros(b, device=device), torch.ones(b, device=device)
+    cos, sin = torch.cos(angle) * s, torch.sin(angle) * s
+
+    m = matrices(one, zero, zero, zero, cos, -sin, zero, sin, cos)
+
+    yiq = rgb_to_yiq.to(device)
+    m = torch.inverse(yiq).matmul(m).matmul(yiq)
+
+    return torch.einsum('bij,bjhw->bihw', m, images)
+
+
+def augment_images(images, grid, args):
+    """ Warp uint8 canvases [B,H,W,C] with bicubic sampling, and apply photometric adjustments """
+    images = images.permute(0, 3, 1, 2).float().div_(255)
+    images = F.grid_sample(images, grid, mode='bicubic', padding_mode='zeros', align_corners=False)
+
+    images = adjust_gamma(images, args.gamma, args.channel_gamma)
+    images = adjust_brightness(images, args.brightness, args.contrast)
+    images = adjust_colours(images, args.hue, args.saturation)
+
+    return images.mul_(255).clamp_(0, 255).round_().byte().permute(0, 2, 3, 1).contiguous()
+
+
+def augment_batch(args, encoder, device):
+    """ Device side of batched augmentation (augment = batched) which takes the raw crops from
+        dataset.detection.random_crop_raw and performs the warp, photometric adjustments, flips,
+        box filtering and target encoding as batched tensor operations.
+    """
+    s = args.scale
+    dest_size = (int(args.train_size * s), int(args.train_size * s))
+
+    def f(data):
+        images = data.image.to(device)
+        n = images.size(0)
+
+        canvas_size = (images.size(2), images.size(1))
+        offset, scale = data.offset.to(device), data.scale.to(device)
+
+        flags = struct(
+            transpose = random_flags(n, args.transposes, device),
+            vertical = random_flags(n, args.vertical_flips, device),
+            horizontal = random_flags(n, args.flips, device))
+
+        grid = sample_grid(offset, scale, flags, dest_size, canvas_size)
+        images = augment_images(images, grid, args)
+
+        target = tensors_to(data.target, device=device)
+        index = torch.arange(n, device=device).repeat_interleave(data.lengths.to(device))
+
+        target = target._extend(bbox = transform_boxes(target.bbox, index, offset, scale, flags, dest_size))
+
+        visible = box.visibility(target.bbox, (0, 0), dest_size).gt(args.min_visible).nonzero(as_tuple=False).squeeze(1)
+        target, index = target._index_select(visible), index[visible]
+
+        lengths = torch.bincount(index, minlength=n)
+        targets = split_table(target, lengths.tolist())
+
+        encoding = encoder.encode_batch(images, targets)
+
+        return struct(
+            image = images,
+            encoding = encoding,
+            target = target,
+            lengths = lengths,
+            id = data.id
+        )
+    return f
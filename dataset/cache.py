@@ -0,0 +1,80 @@
+import os
+import hashlib
+
+import numpy as np
+import torch
+
+
+class ImageCache:
+    """ Cache of decoded images stored as raw uint8 arrays in a directory (shared memory by default),
+        images are memory mapped so pages are shared between DataLoader worker processes and across epochs.
+        Least recently used images are evicted once the total size exceeds max_bytes.
+    """
+
+    def __init__(self, path='/dev/shm/detection', max_bytes=1 << 30):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def filename(self, file):
+        stat = os.stat(file)
+        key = "{}:{}:{}".format(os.path.abspath(file), stat.st_mtime_ns, stat.st_size)
+
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + ".npy")
+
+    def read(self, file, decode):
+        filename = self.filename(file)
+
+        try:
+            # copy on write mapping, so the image can be modified without affecting the cache
+            image = np.load(filename, mmap_mode='c')
+            os.utime(filename)  # mark as recently used
+
+            return torch.from_numpy(image)
+
+        except (FileNotFoundError, ValueError):
+            image = decode(file)
+            self.write(filename, image)
+
+            return image
+
+    def write(self, filename, image):
+        size = image.numel() * image.element_size()
+        if size > self.max_bytes:
+            return
+
+        os.makedirs(self.path, exist_ok=True)
+        self.evict(self.max_bytes - size)
+
+        temp = "{}.{}.tmp".format(filename, os.getpid())
+        with open(temp, "wb") as f:
+            np.save(f, image.numpy())
+
+        os.replace(temp, filename)
+
+    def entries(self):
+        def stat(name):
+            try:
+                return os.stat(os.path.join(self.path, name))
+            except FileNotFoundError:  # removed by another process
+                return None
+
+        files = [(name, stat(name)) for name in os.listdir(self.path) if name.endswith(".npy")]
+        return [(name, s) for name, s in files if s is not None]
+
+    def evict(self, budget):
+        entries = sorted(self.entries(), key=lambda entry: entry[1].st_mtime)
+        total = sum(s.st_size for _, s in entries)
+
+        for name, s in entries:
+            if total <= budget:
+                break
+
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+            total -= s.st_size
+
+    def clear(self):
+        self.evict(0)
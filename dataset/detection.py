@@ -2,6 +2,7 @@ from os import path
 import random
 import math
 from copy import deepcopy
+from functools import partial
 
 import torch
 from torch.utils.data.sampler import RandomSampler
@@ -15,10 +16,11 @@ from tools.dataset.samplers import RepeatSampler
 from tools.image import transforms, cv
 
 from tools.image.index_map import default_map
-from tools import over_struct, tensor, struct, table, cat_tables, Table, Struct, shape
+from tools import over_struct, tensor, struct, table, cat_tables, split_table, Table, Struct, shape
 
 
 from detection import box
+from dataset.cache import ImageCache
 import collections
 
 
@@ -48,6 +50,79 @@ def collate_batch(batch):
     raise TypeError("batch must contain Table, numbers, dicts or lists; found {}".format(elem_type))
 
 
+def split_batch(batch, size):
+    """ Split a collated training batch into micro batches of at most size images, 
+        each micro batch records the size of the whole batch (batch_size) for normalising the loss.
+    """
+    n = batch.image.size(0)
+    if not size or size >= n:
+        return [batch]
+
+    targets = split_table(batch.target, batch.lengths.tolist())
+
+    def micro_batch(start, end):
+        def select(x):
+            if type(x) is Struct:
+                return Struct({k : select(v) for k, v in x.items()})
+            elif (torch.is_tensor(x) and x.dim() > 0 or isinstance(x, list)) and len(x) == n:
+                return x[start:end]
+            return x
+
+        return select(batch)._extend(target = cat_tables(targets[start:end]), batch_size = n)
+
+    return [micro_batch(i, min(i + size, n)) for i in range(0, n, size)]
+
+
+def pad_to(t, size):
+    """ Zero pad the leading (height, width) dimensions of t at the bottom and right """
+    h, w = size
+    if t.size(0) == h and t.size(1) == w:
+        return t
+
+    padded = t.new_zeros(h, w, *t.shape[2:])
+    padded[:t.size(0), :t.size(1)] = t
+    return padded
+
+def pad_images(images):
+    h = max(image.size(0) for image in images)
+    w = max(image.size(1) for image in images)
+
+    return [pad_to(image, (h, w)) for image in images]
+
+
+def pad_encodings(encodings):
+    """ Pad spatial (at least 2d) tensors of each encoding to a common size, 
+        per anchor (1d) tensors are padded at the end (and re-encoded by the model when the input size differs) """
+    def pad_key(k):
+        xs = [e[k] for e in encodings]
+        if not torch.is_tensor(xs[0]) or xs[0].dim() == 0:
+            return xs
+
+        if xs[0].dim() == 1:
+            n = max(x.size(0) for x in xs)
+            return [torch.cat([x, x.new_zeros(n - x.size(0))]) for x in xs]
+
+        return pad_images(xs)
+
+    padded = {k : pad_key(k) for k in encodings[0].keys()}
+    return [Struct({k : xs[i] for k, xs in padded.items()}) for i in range(len(encodings))]
+
+
+def collate_padded(batch):
+    """ Collate images of differing sizes by padding (bottom and right) to the largest in the batch, 
+        spatial tensors of the encoding are padded to match. The original sizes are kept as image_size. 
+    """
+    image_size = torch.LongTensor([[d.image.size(1), d.image.size(0)] for d in batch])
+    images = pad_images([d.image for d in batch])
+
+    batch = [d._extend(image = image) for d, image in zip(batch, images)]
+    if 'encoding' in batch[0]:
+        encodings = pad_encodings([d.encoding for d in batch])
+        batch = [d._extend(encoding = encoding) for d, encoding in zip(batch, encodings)]
+
+    return collate_batch(batch)._extend(image_size = image_size)
+
+
 # Use this to get around pickling problems using multi-processing
 def callable(name, f):
     return type(name, (object,), {'__call__': lambda self, batch: f(batch) })
@@ -59,11 +134,19 @@ empty_target = table (
         label = torch.LongTensor(0))
 
 
-def load_image(image):
-    img = cv.imread_color(image.file)
+def load_image(image, cache=None):
+    img = cv.imread_color(image.file) if cache is None else cache.read(image.file, cv.imread_color)
     return image._extend(image = img, image_size = torch.LongTensor([img.size(1), img.size(0)]))
 
 
+def image_loader(args):
+    """ load_image, using a decoded image cache shared between workers if args.image_cache (MB) is set """
+    if args.image_cache > 0:
+        return partial(load_image, cache=ImageCache(args.cache_dir, max_bytes=args.image_cache * (1 << 20)))
+
+    return load_image
+
+
 def random_mean(mean, magnitude):
     return mean + random.uniform(-magnitude, magnitude)
 
@@ -171,28 +254,35 @@ def as_tuple(bbox):
     b = bbox.tolist()
     return (b[0], b[1]), (b[2], b[3])
 
-def random_crop_padded(dest_size, scale_range=(1, 1), aspect_range=(1, 1), border_bias=0, select_instance=0.5):
+def random_region(d, dest_size, scale_range=(1, 1), aspect_range=(1, 1), border_bias=0, select_instance=0.5):
+    """ Choose a random region to crop, returns the position (x, y) in the input image and scale (sx, sy) """
     cw, ch = dest_size
 
-    def apply(d):
+    scale = random_log(*scale_range)
+    aspect = random_log(*aspect_range)
 
-        scale = random_log(*scale_range)
-        aspect = random_log(*aspect_range)
+    sx, sy = scale * math.sqrt(aspect), scale / math.sqrt(aspect)
 
-        sx, sy = scale * math.sqrt(aspect), scale / math.sqrt(aspect)
+    input_size = (d.image.size(1), d.image.size(0))
+    region_size = (cw / sx, ch / sy)
 
-        input_size = (d.image.size(1), d.image.size(0))
-        region_size = (cw / sx, ch / sy)
+    num_instances = d.target.label.size(0)
+    
+    x, y = transforms.random_crop_padded(input_size, region_size, border_bias=border_bias)
 
-        num_instances = d.target.label.size(0)
-        target_box = None
-        
-        x, y = transforms.random_crop_padded(input_size, region_size, border_bias=border_bias)
+    if (random.uniform(0, 1) < select_instance) and num_instances > 0:
+        instance = random.randint(0, num_instances - 1)
+        x, y = transforms.random_crop_target(input_size, region_size, target_box=as_tuple(d.target.bbox[instance]))
+
+    return (x, y), (sx, sy)
 
-        if (random.uniform(0, 1) < select_instance) and num_instances > 0:
-            instance = random.randint(0, num_instances - 1)
-            x, y = transforms.random_crop_target(input_size, region_size, target_box=as_tuple(d.target.bbox[instance]))
 
+def random_crop_padded(dest_size, scale_range=(1, 1), aspect_range=(1, 1), border_bias=0, select_instance=0.5):
+    cw, ch = dest_size
+
+    def apply(d):
+        (x, y), (sx, sy) = random_region(d, dest_size, scale_range, aspect_range, border_bias, select_instance)
+        region_size = (cw / sx, ch / sy)
 
         centre = (x + region_size[0] * 0.5, y + region_size[1] * 0.5)
         t = transforms.make_affine(dest_size, centre, scale=(sx, sy))
@@ -204,6 +294,43 @@ def random_crop_padded(dest_size, scale_range=(1, 1), aspect_range=(1, 1), borde
     return apply
 
 
+def crop_canvas(image, x, y, canvas_size):
+    """ Integer crop of image at (x, y), zero padded where the canvas extends outside the image """
+    w, h = canvas_size
+    canvas = image.new_zeros(h, w, image.size(2))
+
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + w, image.size(1)), min(y + h, image.size(0))
+
+    if x1 > x0 and y1 > y0:
+        canvas[y0 - y:y1 - y, x0 - x:x1 - x] = image[y0:y1, x0:x1]
+    return canvas
+
+
+def random_crop_raw(dest_size, canvas_size, scale_range=(1, 1), aspect_range=(1, 1), border_bias=0, select_instance=0.5):
+    """ Worker side of batched augmentation (dataset.augment), selects a region as random_crop_padded but only
+        copies the raw pixels to a fixed size canvas. The sub-pixel offset and scale of the region are
+        passed on so the warp can be performed on the training device.
+    """
+    def apply(d):
+        (x, y), (sx, sy) = random_region(d, dest_size, scale_range, aspect_range, border_bias, select_instance)
+        x0, y0 = math.floor(x), math.floor(y)
+
+        target = d.target._extend(bbox = box.transform(d.target.bbox, (-x0, -y0)))
+        target = box.filter_hidden(target, (0, 0), canvas_size)
+
+        return struct(
+            image   = crop_canvas(d.image, x0, y0, canvas_size),
+            encoding = struct(),
+            target = target,
+            lengths = len(target.label),
+            offset = torch.FloatTensor([x - x0, y - y0]),
+            scale = torch.FloatTensor([sx, sy]),
+            id = d.id
+        )
+    return apply
+
+
 def filter_boxes(min_visible = 0.4):   
     def apply(d):
         size = (d.image.size(1), d.image.size(0))
@@ -236,8 +363,50 @@ def sample_training(args, images, loader, transform, collate_fn=collate_batch):
         sampler=sampler,
         collate_fn=collate_fn)
 
-def load_testing(args, images, collate_fn=collate_batch):
-    return DataLoader(images, num_workers=args.num_workers, batch_size=1, collate_fn=collate_fn)
+class SizeBatches:
+    """ Batches of (up to) batch_size images of equal size from a loader of single images,
+        so images are never padded together and results don't depend on which images share a batch. 
+        At most max_pending images wait for a full batch, past that the largest bucket is emitted as is.
+        The number of batches depends on the image sizes, num_images is the number of images. """
+
+    def __init__(self, loader, batch_size, collate_fn, max_pending=None):
+        self.loader = loader
+        self.batch_size = batch_size
+        self.collate_fn = collate_fn
+        self.max_pending = 4 * batch_size if max_pending is None else max_pending
+
+        self.num_images = len(loader)
+
+    def __iter__(self):
+        buckets = {}
+        pending = 0
+
+        for d in self.loader:
+            size = tuple(d.image.shape)
+            bucket = buckets.setdefault(size, [])
+            bucket.append(d)
+            pending += 1
+
+            if len(bucket) == self.batch_size:
+                pending -= len(bucket)
+                yield self.collate_fn(buckets.pop(size))
+
+            elif pending > self.max_pending:
+                largest = max(buckets, key=lambda k: len(buckets[k]))
+                pending -= len(buckets[largest])
+                yield self.collate_fn(buckets.pop(largest))
+
+        for bucket in buckets.values():
+            yield self.collate_fn(bucket)
+
+
+def load_testing(args, images, collate_fn=collate_padded, batch_size=None):
+    batch_size = args.test_batch_size if batch_size is None else batch_size
+    if batch_size == 1:
+        return DataLoader(images, num_workers=args.num_workers, batch_size=1, collate_fn=collate_fn)
+
+    loader = DataLoader(images, num_workers=args.num_workers, batch_size=None, collate_fn=identity)
+    return SizeBatches(loader, batch_size, collate_fn)
 
 def encode_target(encoder):
     def f(d):
@@ -259,7 +428,16 @@ def identity(x):
 
 
 def encode_with(args, encoder=None):
-    return identity if encoder is None else  encode_target(encoder)    
+    return identity if encoder is None else  encode_target(deepcopy(encoder).to('cpu'))    
+
+
+def canvas_size(dest_size, scale_range, aspect_range):
+    """ Canvas large enough for any region chosen by random_region (plus one pixel for the sub-pixel offset) """
+    cw, ch = dest_size
+    min_scale, max_aspect = scale_range[0], aspect_range[1]
+
+    return (math.ceil(cw * math.sqrt(max_aspect) / min_scale) + 1, 
+            math.ceil(ch * math.sqrt(max_aspect) / min_scale) + 1)
 
 
 def transform_training(args, encoder=None):
@@ -268,15 +446,21 @@ def transform_training(args, encoder=None):
 
     crop = identity
 
-    if args.augment == "crop":
-        min_scale = args.min_scale or (1/args.max_scale)
+    min_scale = args.min_scale or (1/args.max_scale)
+    scale_range = (s * min_scale, s * args.max_scale)
+    aspect_range = (1/args.max_aspect, args.max_aspect)
 
-        crop = random_crop_padded(dest_size, scale_range = (s * min_scale, s * args.max_scale), 
-            aspect_range=(1/args.max_aspect, args.max_aspect), border_bias = args.border_bias, select_instance = args.select_instance)
+    if args.augment == "crop":
+        crop = random_crop_padded(dest_size, scale_range = scale_range, 
+            aspect_range=aspect_range, border_bias = args.border_bias, select_instance = args.select_instance)
+    elif args.augment == "batched":
+        # warp, photometric adjustments, flips and encoding are done on the training device (dataset.augment)
+        return multiple(args.image_samples, random_crop_raw(dest_size, canvas_size(dest_size, scale_range, aspect_range), 
+            scale_range = scale_range, aspect_range=aspect_range, border_bias = args.border_bias, select_instance = args.select_instance))
     elif args.augment == "resize":
         crop = resize_to(dest_size)
     else:
-        assert false, "unknown augmentation method " + args.augment
+        assert False, "unknown augmentation method " + args.augment
 
     filter = filter_boxes(min_visible=args.min_visible)
     flip   = random_flips(horizontal=args.flips, vertical=args.vertical_flips, transposes=args.transposes)
@@ -292,7 +476,7 @@ def transform_training(args, encoder=None):
 
     
 
-    encode = encode_with(args, deepcopy(encoder).to('cpu')) 
+    encode = encode_with(args, encoder) 
     return multiple(args.image_samples, transforms.compose (crop, adjust_light, filter, flip, encode))
 
 def multiple(n, transform):
@@ -311,7 +495,7 @@ def transform_testing(args, encoder=None):
     """
     transform = identity
 
-    if args.augment == "crop":
+    if args.augment in ["crop", "batched"]:
         transform = resize(args.resize) if args.resize is not None \
             else scale(args.scale) if (args.scale != 1) \
             else identity      
@@ -341,7 +525,7 @@ def least_recently_evaluated(images, n = None):
 
 class DetectionDataset:
 
-    def __init__(self, images = {}, classes=[]):
+    def __init__(self, images = {}, classes=[], loader=None):
 
         assert type(images) is dict, "expected images as a dict"
         assert type(classes) is list, "expected classes as a list"
@@ -349,6 +533,12 @@ class DetectionDataset:
         self.images = images
         self.classes = classes
 
+        # e.g. images served from a packed dataset, otherwise images are loaded from file
+        self.loader = loader
+
+    def image_loader(self, args):
+        return self.loader or image_loader(args)
+
   
   
 
@@ -400,7 +590,7 @@ class DetectionDataset:
         return all_images
 
     def train(self, args, encoder, collate=collate_batch):
-        images = FlatList(self.train_images, loader = load_image,
+        images = FlatList(self.train_images, loader = self.image_loader(args),
             transform = transform_training(args, encoder=encoder))
 
         return load_training(args, images, collate_fn=flatten(collate))
@@ -409,7 +599,7 @@ class DetectionDataset:
         return self.sample_train_on(self.train_images, args, encoder, collate=collate)
 
     def sample_train_on(self, images, args, encoder, collate=collate_batch):
-        return sample_training(args, images, load_image,
+        return sample_training(args, images, self.image_loader(args),
             transform = transform_training(args, encoder=encoder), collate_fn=flatten(collate))
 
 
@@ -419,15 +609,15 @@ class DetectionDataset:
 
         return transform(load_image(d)).image
 
-    def test_on(self, images, args, encoder, collate=collate_batch):
-        dataset = FlatList(images, loader = load_image, transform = transform_testing(args, encoder=encoder))
-        return load_testing(args, dataset, collate_fn=collate)
+    def test_on(self, images, args, encoder, collate=collate_padded, batch_size=None):
+        dataset = FlatList(images, loader = self.image_loader(args), transform = transform_testing(args, encoder=encoder))
+        return load_testing(args, dataset, collate_fn=collate, batch_size=batch_size)
 
-    def test(self, args, encoder, collate=collate_batch):
-        return self.test_on(self.test_images, args, encoder, collate=collate)
+    def test(self, args, encoder, collate=collate_padded, batch_size=None):
+        return self.test_on(self.test_images, args, encoder, collate=collate, batch_size=batch_size)
 
-    def validate(self, args, encoder, collate=collate_batch):
-        return self.test_on(self.validate_images, args, encoder, collate=collate)
+    def validate(self, args, encoder, collate=collate_padded, batch_size=None):
+        return self.test_on(self.validate_images, args, encoder, collate=collate, batch_size=batch_size)
 
 
     def add_noise(self, noise = 0, offset = 0):
@@ -4,6 +4,7 @@ from .voc import import_voc
 from tools.parameters import get_choice
 from tools import struct
 from dataset.annotate import decode_dataset
+from dataset.packed import load_packed
 
 import json
 
@@ -107,6 +108,13 @@ def import_dataset(input_args, subset=None):
 
 
 def load_dataset(args):
+    choice, params = get_choice(args.input)
+
+    if choice == 'packed':
+        assert not (args.subset or args.keep_classes), "subsets are not supported on packed datasets"
+
+        print("loading packed dataset from: " + params.path)
+        return load_packed(params.path)
 
     subset = args.subset.split(",") if args.subset else None
     keep_classes = args.keep_classes.split(",") if args.keep_classes else subset
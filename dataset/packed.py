@@ -0,0 +1,123 @@
+import os
+import json
+
+import numpy as np
+import torch
+
+from tools import struct, table, to_structs
+
+from dataset.detection import DetectionDataset, load_image, identity
+
+# File layout:  magic | images (uint8 [H, W, C]) | bbox (float32 [n, 4]) | label (int64 [n]) | header (json) | footer
+# The footer holds the offset and length of the header, all arrays are aligned to 64 bytes.
+
+magic = b'DETPACK1'
+alignment = 64
+
+
+def write_aligned(f, data):
+    padding = (-f.tell()) % alignment
+    f.write(b'\0' * padding)
+
+    offset = f.tell()
+    f.write(data)
+    return offset
+
+
+def pack_dataset(filename, config, dataset, transform=identity):
+    """ Pack a DetectionDataset into a single file of decoded images (optionally transformed e.g. downscaled)
+        with a compact index of boxes and labels.
+    """
+    entries, boxes, labels = [], [], []
+    num_boxes = 0
+
+    temp = filename + ".tmp"
+    with open(temp, "wb") as f:
+        f.write(magic)
+
+        for image in dataset.images.values():
+            d = transform(load_image(image))
+            data = d.image.contiguous().numpy()
+
+            n = d.target.label.size(0)
+            entries.append(dict(id = image.id, file = image.file, category = image.category,
+                offset = write_aligned(f, data.tobytes()), shape = list(data.shape), boxes = [num_boxes, num_boxes + n]))
+
+            boxes.append(d.target.bbox.float().numpy())
+            labels.append(d.target.label.long().numpy())
+            num_boxes += n
+
+        bbox = np.concatenate(boxes).reshape(-1, 4) if num_boxes > 0 else np.zeros((0, 4), dtype=np.float32)
+        label = np.concatenate(labels) if num_boxes > 0 else np.zeros((0,), dtype=np.int64)
+
+        header = dict(config = config._to_dicts(), images = entries, num_boxes = num_boxes,
+            bbox = write_aligned(f, bbox.astype(np.float32).tobytes()),
+            label = write_aligned(f, label.astype(np.int64).tobytes()))
+
+        header_offset = write_aligned(f, json.dumps(header).encode())
+        f.write(np.array([header_offset, f.tell() - header_offset], dtype=np.uint64).tobytes())
+
+    os.replace(temp, filename)
+
+
+def read_header(filename):
+    with open(filename, "rb") as f:
+        assert f.read(len(magic)) == magic, "read_header: not a packed dataset " + filename
+
+        f.seek(-16, os.SEEK_END)
+        offset, length = np.frombuffer(f.read(16), dtype=np.uint64).tolist()
+
+        f.seek(offset)
+        return json.loads(f.read(length).decode())
+
+
+class PackedImages:
+    """ Loader serving images from a packed dataset as zero-copy (copy on write) views of a memory mapped file,
+        the file is mapped lazily so that it can be passed to DataLoader worker processes.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.header = read_header(filename)
+
+        self.entries = {entry['id'] : entry for entry in self.header['images']}
+        self.data = None
+
+    def __getstate__(self):
+        return dict(self.__dict__, data = None)
+
+    def array(self, offset, dtype, shape):
+        if self.data is None:
+            self.data = np.memmap(self.filename, dtype=np.uint8, mode='c')
+
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        return torch.from_numpy(self.data[offset:offset + size].view(dtype).reshape(shape))
+
+    def image(self, id):
+        entry = self.entries[id]
+        return self.array(entry['offset'], np.uint8, entry['shape'])
+
+    def target(self, id):
+        start, end = self.entries[id]['boxes']
+        n = self.header['num_boxes']
+
+        bbox = self.array(self.header['bbox'], np.float32, (n, 4))
+        label = self.array(self.header['label'], np.int64, (n,))
+
+        return table(bbox = bbox[start:end], label = label[start:end])
+
+    def __call__(self, image):
+        img = self.image(image.id)
+        return image._extend(image = img, image_size = torch.LongTensor([img.size(1), img.size(0)]))
+
+
+def load_packed(filename):
+    """ Load a packed dataset, returns (config, DetectionDataset) as per dataset.annotate.decode_dataset """
+    packed = PackedImages(filename)
+    config = to_structs(packed.header['config'])
+
+    classes = [struct(id = int(k), **v) for k, v in config.classes.items()]
+
+    images = {entry['id'] : struct(id = entry['id'], file = entry['file'],
+        category = entry['category'], target = packed.target(entry['id'])) for entry in packed.header['images']}
+
+    return config, DetectionDataset(classes = classes, images = images, loader = packed)
@@ -39,7 +39,8 @@ def point_form(boxes):
 def transform(boxes, offset=(0, 0), scale=(1, 1)):
     lower, upper = boxes[:, :2], boxes[:, 2:]
 
-    offset, scale = torch.Tensor(offset), torch.Tensor(scale)
+    offset = torch.as_tensor(offset, dtype=boxes.dtype, device=boxes.device)
+    scale = torch.as_tensor(scale, dtype=boxes.dtype, device=boxes.device)
 
     lower = lower.add(offset).mul(scale)
     upper = upper.add(offset).mul(scale)
@@ -68,15 +69,18 @@ def filter_invalid(target):
     valid = (boxes[:, 2] - boxes[:, 0] > 0) & (boxes[:, 3] - boxes[:, 1] > 0)
     return target[valid.nonzero(as_tuple=False).squeeze(1)]
 
+def visibility(boxes, lower, upper):
+    bounds = boxes.new_tensor([[*lower, *upper]])
+    return intersect(bounds.expand_as(boxes), boxes) / area(boxes)
+
 def filter_hidden(target, lower, upper, min_visible=0.0):
-    bounds = torch.Tensor([[*lower, *upper]])
-    overlaps = (intersect_matrix(bounds, target.bbox) / area(target.bbox)).squeeze(0)
+    overlaps = visibility(target.bbox, lower, upper)
     return target._index_select(overlaps.gt(min_visible).nonzero(as_tuple=False).squeeze(1))
 
 
 
 def area(boxes):
-    x1, y1, x2, y2 = boxes[:,0], boxes[:,1], boxes[:,2], boxes[:,3]
+    x1, y1, x2, y2 = split4(boxes)
     return (x2-x1) * (y2-y1)
 
 def clamp(boxes, lower, upper):
@@ -90,23 +94,18 @@ def clamp(boxes, lower, upper):
 
 
 def intersect_matrix(box_a, box_b):
-    """ Intersection matrix of bounding boxes
+    """ Intersection matrix of bounding boxes (leading batch dimensions are broadcast)
     Args:
-      box_a: (tensor) bounding boxes, Shape: [n,4].
-      box_b: (tensor) bounding boxes, Shape: [m,4].
+      box_a: (tensor) bounding boxes, Shape: [..., n,4].
+      box_b: (tensor) bounding boxes, Shape: [..., m,4].
     Return:
-      (tensor) intersection area, Shape: [n,m].
+      (tensor) intersection area, Shape: [..., n,m].
     """
-    n = box_a.size(0)
-    m = box_b.size(0)
-
+    max_xy = torch.min(box_a[..., :, None, 2:], box_b[..., None, :, 2:])
+    min_xy = torch.max(box_a[..., :, None, :2], box_b[..., None, :, :2])
 
-    max_xy = torch.min(box_a[:, 2:].unsqueeze(1).expand(n, m, 2),
-                       box_b[:, 2:].unsqueeze(0).expand(n, m, 2))
-    min_xy = torch.max(box_a[:, :2].unsqueeze(1).expand(n, m, 2),
-                       box_b[:, :2].unsqueeze(0).expand(n, m, 2))
     inter = torch.clamp((max_xy - min_xy), min=0)
-    return inter[:, :, 0] * inter[:, :, 1]
+    return inter[..., 0] * inter[..., 1]
 
 def intersect(box_a, box_b):
     assert box_a.shape == box_b.shape
@@ -120,29 +119,148 @@ def intersect(box_a, box_b):
 def union_matrix(box_a, box_b):
     """Compute the union area matrix between two sets of boxes in point form.
     Args:
-        box_a, box b: Bounding boxes in point form. shapes ([n, 4], [m, 4])
+        box_a, box b: Bounding boxes in point form. shapes ([..., n, 4], [..., m, 4])
     Return:
-        intersection: (tensor) Shape: [n, m]
-        union: (tensor) Shape: [n, m]
+        intersection: (tensor) Shape: [..., n, m]
+        union: (tensor) Shape: [..., n, m]
     """
     inter = intersect_matrix(box_a, box_b)
-    area_a = ((box_a[:, 2]-box_a[:, 0]) *
-              (box_a[:, 3]-box_a[:, 1])).unsqueeze(1).expand_as(inter)  # [n,m]
-    area_b = ((box_b[:, 2]-box_b[:, 0]) *
-              (box_b[:, 3]-box_b[:, 1])).unsqueeze(0).expand_as(inter)  # [n,m]
+    area_a = area(box_a).unsqueeze(-1)  # [..., n, 1]
+    area_b = area(box_b).unsqueeze(-2)  # [..., 1, m]
+
     unions = area_a + area_b - inter
-    return inter, unions  # [n,m]    
+    return inter, unions  # [..., n,m]    
 
 def iou_matrix(box_a, box_b):
     """Compute the IOU of two sets of boxes in point form.
     Args:
-        box_a, box b: Bounding boxes in point form. shapes ([n, 4], [m, 4])
+        box_a, box b: Bounding boxes in point form. shapes ([..., n, 4], [..., m, 4])
     Return:
-        jaccard overlap: (tensor) Shape: [n, m]
+        jaccard overlap: (tensor) Shape: [..., n, m]
     """
     inter, union = union_matrix(box_a, box_b)
     return inter / union
 
+# memory budget for temporaries of one block of an iou matrix
+block_bytes = 64 * (1 << 20)
+
+def block_rows(box_a, box_b, max_bytes=block_bytes):
+    """ Number of rows of box_a per block so that temporaries (roughly 12 floats per pair) fit in max_bytes """
+    batch = max(box_a.shape[:-2].numel(), box_b.shape[:-2].numel())
+    return max(1, max_bytes // (max(1, box_b.size(-2)) * batch * box_a.element_size() * 12))
+
+def iou_blocks(box_a, box_b, max_bytes=block_bytes):
+    """ Iterate over row blocks of iou_matrix(box_a, box_b) as (start, ious [..., rows, m]) 
+        with temporaries bounded by max_bytes. """
+    n = box_a.size(-2)
+    rows = block_rows(box_a, box_b, max_bytes)
+
+    for start in range(0, max(n, 1), rows):
+        yield start, iou_matrix(box_a[..., start:start + rows, :], box_b)
+
+
+def iou_reduce(box_a, box_b, top_k=0, max_bytes=block_bytes):
+    """ Fused reductions of iou_matrix(box_a, box_b) [..., n, m] computed block-wise, without materialising the full matrix.
+    Return:
+        max_ious, max_ids: maximum over columns for each row, Shape: [..., n]
+        top_ious, top_ids: (if top_k > 0) top k rows for each column, Shape: [..., k, m]
+    """
+    max_ious, max_ids = [], []
+    top_ious, top_ids = None, None
+
+    for start, ious in iou_blocks(box_a, box_b, max_bytes):
+        block_max, block_ids = ious.max(-1)
+        max_ious.append(block_max)
+        max_ids.append(block_ids)
+
+        if top_k > 0:
+            block_top, block_inds = ious.topk(min(top_k, ious.size(-2)), dim=-2)
+            block_inds = block_inds + start
+
+            if top_ious is not None:
+                block_top, inds = torch.cat([top_ious, block_top], -2).topk(min(top_k, top_ious.size(-2) + block_top.size(-2)), dim=-2)
+                block_inds = torch.cat([top_ids, block_inds], -2).gather(-2, inds)
+
+            top_ious, top_ids = block_top, block_inds
+
+    return struct(max_ious = torch.cat(max_ious, -1), max_ids = torch.cat(max_ids, -1), 
+        top_ious = top_ious, top_ids = top_ids)
+
+
+class BoxIndex:
+    """ Uniform grid index over a set of boxes [m, 4] (point form) for bulk overlap queries. 
+        Each box is entered in every grid cell it covers, entries are kept sorted by cell, 
+        so queries are a sorted search and cost is roughly linear in the number of boxes and overlaps.
+    """
+    def __init__(self, boxes, cell_size=None):
+        self.boxes = boxes
+
+        size = (boxes[:, 2:] - boxes[:, :2]).max(1).values if boxes.size(0) > 0 else boxes.new_ones(1)
+        self.cell_size = cell_size or max(size.mean().item(), 1e-3)
+
+        lower, upper = self.cell_range(boxes) if boxes.size(0) > 0 else (boxes.new_zeros(1, 2).long(),) * 2
+        self.origin = lower.min(0).values
+        self.grid_size = upper.max(0).values - self.origin + 1
+
+        index, cells = self.box_cells(boxes)
+        self.cells, order = cells.sort()
+        self.index = index[order]
+
+    def cell_range(self, boxes):
+        return (boxes[:, :2] / self.cell_size).floor().long(), (boxes[:, 2:] / self.cell_size).floor().long()
+
+    def clamped_range(self, boxes):
+        lower, upper = self.cell_range(boxes)
+        return (lower - self.origin).clamp(min=0), torch.min(upper - self.origin, self.grid_size - 1)
+
+    def box_cells(self, boxes):
+        """ Expand boxes to (box index, cell) entries for the cells (within the grid) each box covers """
+        lower, upper = self.clamped_range(boxes)
+
+        size = (upper - lower + 1).clamp(min=0)
+        counts = size[:, 0] * size[:, 1]
+
+        index = torch.arange(boxes.size(0), device=boxes.device).repeat_interleave(counts)
+        offsets = torch.arange(index.size(0), device=boxes.device) - (counts.cumsum(0) - counts)[index]
+
+        x = lower[index, 0] + offsets % size[index, 0]
+        y = lower[index, 1] + offsets // size[index, 0]
+        return index, y * self.grid_size[0] + x
+
+    def query_overlapping(self, boxes, min_iou=0.0):
+        """ Find pairs of query boxes [n, 4] and indexed boxes with iou > min_iou.
+        Return:
+            struct of query index i, indexed box j and their iou, each Shape: [k] (sorted by i, then j)
+        """
+        query, cells = self.box_cells(boxes)
+
+        start = torch.searchsorted(self.cells, cells, right=False)
+        counts = torch.searchsorted(self.cells, cells, right=True) - start
+
+        entry = torch.arange(query.size(0), device=boxes.device).repeat_interleave(counts)
+        offsets = torch.arange(entry.size(0), device=boxes.device) - (counts.cumsum(0) - counts)[entry]
+
+        i, j, cell = query[entry], self.index[start[entry] + offsets], cells[entry]
+
+        # each pair is found in every cell both boxes cover, keep only the first (lower corner of the intersection)
+        first = torch.max(self.clamped_range(boxes[i])[0], self.clamped_range(self.boxes[j])[0])
+        unique = (first[:, 1] * self.grid_size[0] + first[:, 0]) == cell
+        i, j = i[unique], j[unique]
+
+        ious = iou(boxes[i], self.boxes[j])
+        keep = ious > min_iou
+
+        i, j, ious = i[keep], j[keep], ious[keep]
+        order = (i * self.boxes.size(0) + j).argsort()
+
+        return struct(i = i[order], j = j[order], iou = ious[order])
+
+
+def overlapping_pairs(box_a, box_b, min_iou=0.0, cell_size=None):
+    """ Sparse alternative to iou_matrix, returns struct(i, j, iou) for pairs with iou > min_iou """
+    return BoxIndex(box_b, cell_size=cell_size).query_overlapping(box_a, min_iou=min_iou)
+
+
 def union(box_a, box_b):  
     assert box_a.shape == box_b.shape
 
@@ -1,22 +1,94 @@
 
 import torch
 import torchvision.ops as torchvision
-from tools import table, struct
+from tools import table, struct, split_table
+
+from detection import nms as detection_nms
 
 
 
 nms_defaults = struct(
     nms         = 0.5,
     threshold   = 0.05,
-    detections  = 500
+    detections  = 500,
+    candidates  = 1000,   # (retina) top candidates per pyramid level decoded before nms
+    per_class   = False,  # suppress overlapping boxes within each class only
+
+    method      = 'hard', # hard | soft | matrix
+    sigma       = 0.5     # gaussian decay for soft and matrix nms
 )
 
+nms_methods = ['hard', 'soft', 'matrix']
+
+
 def nms(prediction, params):
+    return nms_batch(prediction, 1, params)[0]
+
+
+def take_batch(image, params, batch_size):
+    """ Indexes of the first params.detections of each image (image index sorted by descending confidence),
+        and the number of detections taken from each image.
+    """
+    image, order = image.sort(stable=True)
+    counts = image.bincount(minlength=batch_size)
+
+    rank = torch.arange(image.size(0), device=image.device) - (counts.cumsum(0) - counts)[image]
+    return order[rank < params.detections], counts.clamp(max=params.detections)
+
+
+def nms_batch(prediction, batch_size, params, index=None):
+    """ Non maxima suppression for a batch of predictions flattened to a table of size [B * N] 
+        thresholding, nms and take over all images at once. Returns a list of tables. 
+        The index of each detection (within an image) is given by index [B * N] if provided. """
+    params = nms_defaults._merge(params)
+    assert params.method in nms_methods, "unknown nms method: " + params.method
+
+    if params.method != 'hard':
+        return decay_nms_batch(prediction, batch_size, params, index=index)
+
+    n = prediction._size // batch_size
+
     inds = (prediction.confidence >= params.threshold).nonzero(as_tuple=False).squeeze(1)
-    prediction = prediction._index_select(inds)._extend(index = inds)
+    prediction = prediction._index_select(inds)._extend(index = inds % max(n, 1) if index is None else index[inds])
+
+    image = inds // max(n, 1)
+    groups = prediction.label * batch_size + image if params.per_class else image
+
+    inds = torchvision.batched_nms(prediction.bbox, prediction.confidence, groups, params.nms)
+    take, counts = take_batch(image[inds], params, batch_size)
+
+    return split_table(prediction._index_select(inds[take]), counts.tolist())
+
+
+def decay_nms_batch(prediction, batch_size, params, index=None):
+    """ Soft or matrix nms over the top params.candidates of each image, fixed size until the final selection. """
+    n = prediction._size // batch_size
+    k = min(n, params.candidates)
+    device = prediction.confidence.device
+
+    offsets = torch.arange(batch_size, device=device).unsqueeze(1)
+    index = torch.arange(n, device=device).repeat(batch_size) if index is None else index
+
+    confidence, inds = prediction.confidence.view(batch_size, n).topk(k, dim=1)
+    candidates = prediction._index_select((inds + offsets * n).view(-1))
+
+    confidence = confidence.masked_fill(confidence < params.threshold, 0)
+    bbox, label = candidates.bbox.view(batch_size, k, 4), candidates.label.view(batch_size, k)
+    ious = detection_nms.candidate_ious(bbox, label if params.per_class else None)
+
+    if params.method == 'matrix':
+        scores = detection_nms.matrix_nms(ious, confidence, sigma=params.sigma)
+        scores, order = scores.topk(min(k, params.detections), dim=1)
+    else:
+        order, scores = detection_nms.soft_nms(ious, confidence, min(k, params.detections), sigma=params.sigma)
+
+    valid = scores >= params.threshold
+    take = (order + offsets * k)[valid]
+
+    detections = candidates._index_select(take)._extend(confidence = scores[valid], 
+        index = index[(inds + offsets * n).view(-1)][take])
 
-    inds = torchvision.nms(prediction.bbox, prediction.confidence, params.nms)
-    return prediction._index_select(inds)._take(params.detections)
+    return split_table(detections, valid.sum(1).tolist())
 
 
 empty_detections = table (
@@ -32,16 +32,19 @@ def take_max_2d(t):
     return v, (i, j)
 
 def match_targets(target1, target2, threshold=0.5):
-    ious = box.iou_matrix(target1.bbox, target2.bbox)
+    """ Greedy matching of boxes in order of decreasing iou, using only the sparse overlapping pairs """
+    pairs = box.overlapping_pairs(target1.bbox, target2.bbox, min_iou=threshold)
+    order = pairs.iou.argsort(descending=True)
+
     matches = []
+    matched1, matched2 = set(), set()
 
-    if ious.size(0) == 0 or ious.size(1) == 0:
-        return []
+    for i, j, iou in zip(pairs.i[order].tolist(), pairs.j[order].tolist(), pairs.iou[order].tolist()):
+        if i not in matched1 and j not in matched2:
+            matched1.add(i)
+            matched2.add(j)
 
-    value, loc = take_max_2d(ious)
-    while value > threshold:
-        matches.append(struct(match=loc, iou=value))
-        value, loc = take_max_2d(ious)
+            matches.append(struct(match=(j, i), iou=iou))
 
     return matches
 
@@ -111,45 +114,197 @@ def compute_mAP(matches, confidence, num_target, weight=1, eps=1e-7):
 
         mAP = area_under_curve(recall, precision))
 
+def bookend_rows(xs, first, last=None):
+    columns = [xs.new_full((xs.size(0), 1), first), xs] 
+    if last is not None:
+        columns.append(xs.new_full((xs.size(0), 1), last))
+
+    return torch.cat(columns, 1)
+
+def rev_cummax_rows(v):
+    flipped = v.flip(1).numpy()
+    rev_max = np.maximum.accumulate(flipped, axis=1)
+    return torch.from_numpy(rev_max).flip(1)
+
+
+def compute_mAPs(matches, confidence, num_target, eps=1e-7):
+    """ As compute_mAP, for matches at several iou thresholds at once.
+    Args:
+        matches: (tensor) matches sorted by confidence for each threshold, Shape: [t, n]
+        confidence: (tensor) sorted confidence, Shape: [n]
+    Return:
+        list of pr curves (one per threshold) 
+    """
+    matches = matches.float()
+
+    false_positives = (1 - matches).cumsum(1)
+    true_positives = matches.cumsum(1)
+
+    recall = true_positives / (num_target if num_target > 0 else 1)
+    precision = true_positives / (true_positives + false_positives).clamp(min = eps)
+
+    recall = bookend_rows(recall, 0.0, 1.0)
+    precision = rev_cummax_rows(bookend_rows(precision, 1.0, 0.0))
+
+    false_positives = bookend_rows(false_positives, 0)
+    true_positives = bookend_rows(true_positives, 0)
+
+    # recall is non decreasing, so steps of zero width contribute nothing
+    mAP = ((recall[:, 1:] - recall[:, :-1]) * precision[:, 1:]).sum(1)
+    confidence = bookend(1.0, confidence, 0.0)
+
+    def threshold_pr(i):
+        return struct(
+            recall = recall[i], 
+            precision = precision[i], 
+
+            confidence = confidence,
+
+            false_positives = false_positives[i],
+            true_positives = true_positives[i],
+
+            false_negatives = num_target - true_positives[i],  
+            n = num_target,
+
+            mAP = mAP[i].item())
+
+    return [threshold_pr(i) for i in range(matches.size(0))]
+
+
 def mAP_matches(matches, num_target, eps=1e-7):
     true_positives = torch.FloatTensor([0 if m.match is None else 1 for m in matches])
     return compute_mAP(true_positives, num_target, eps)
 
 
-def _match_positives(labels_pred, labels_target, ious, threshold=0.5):
+# lowest iou threshold used in evaluation, only overlaps above this are kept for matching
+min_match_iou = 0.3
+
+def sparse_ious(detections, target, min_iou=min_match_iou):
+    """ Overlaps between detections [n] and targets [m] with iou > min_iou, in compact sparse (COO) form 
+        with rows i, columns j and values iou each of shape [k] (sorted by i then j). 
+    """
+    pairs = box.overlapping_pairs(detections.bbox, target.bbox, min_iou=min_iou)
+    return struct(i = pairs.i.int().cpu(), j = pairs.j.int().cpu(), iou = pairs.iou.float().cpu(), 
+        size = (detections._size, target._size), min_iou = min_iou)
+
+
+def dense_to_sparse(ious, min_iou):
+    i, j = (ious > min_iou).nonzero(as_tuple=True)
+    return struct(i = i.int().cpu(), j = j.int().cpu(), iou = ious[i, j].float().cpu(), size = tuple(ious.shape), min_iou = min_iou)
+
+
+def match_sparse(labels_pred, labels_target, ious, thresholds):
+    """ Greedy matching of predictions (in order of confidence) to targets, 
+        computed for several iou thresholds in one pass over the sparse ious.
+    Args:
+        labels_pred, labels_target: (tensor) labels, shapes [n], [m]
+        ious: sparse ious from sparse_ious (thresholds must be at least ious.min_iou)
+        thresholds: list of iou thresholds [t]
+    Return:
+        matches: (tensor) 1 for true positives, 0 otherwise, Shape: [t, n]
+    """
+    n, m = labels_pred.size(0), labels_target.size(0)
+    assert ious.size == (n, m)
+
+    thresholds = np.array(thresholds, dtype=np.float64).reshape(-1)
+    assert thresholds.size == 0 or thresholds.min() >= ious.min_iou, "match_sparse: threshold below min_iou of sparse ious"
+
+    matches = np.zeros((thresholds.size, n), dtype=np.float32)
+    if ious.i.size(0) == 0:
+        return torch.from_numpy(matches)
+
+    # targets for each prediction in descending order of iou (ties in order of target)
+    i, j, values = ious.i.numpy(), ious.j.numpy(), ious.iou.numpy()
+    order = np.lexsort((j, -values, i))
+    i, j, values = i[order], j[order], values[order]
+
+    rows_start = np.searchsorted(i, np.arange(n + 1))
+    label_pred, label_target = labels_pred.cpu().numpy(), labels_target.cpu().numpy()
+
+    available = np.ones((thresholds.size, m), dtype=bool)
+    rows = np.arange(thresholds.size)
+
+    # predictions which overlap nothing can't match or take a target at any threshold
+    for k in np.flatnonzero(rows_start[1:] > rows_start[:-1]):
+        candidates = slice(rows_start[k], rows_start[k + 1])
+        targets = j[candidates]
+
+        free = available[:, targets]
+        best = free.argmax(1)      # best remaining target for each threshold
+
+        hit = free[rows, best] & (values[candidates][best] > thresholds)
+        available[rows[hit], targets[best[hit]]] = False  # targets can't be selected twice
+
+        matches[hit, k] = label_pred[k] == label_target[targets[best[hit]]]
+
+    return torch.from_numpy(matches)
+
+
+def match_greedy(labels_pred, labels_target, ious, thresholds):
+    """ As match_sparse, from a dense iou matrix [n, m] """
     n, m = labels_pred.size(0), labels_target.size(0)
     assert ious.size() == torch.Size([n, m]) 
-    ious = ious.clone()
 
-    matches = torch.FloatTensor(n).zero_()
+    min_iou = min(thresholds) if len(thresholds) > 0 else 0
+    return match_sparse(labels_pred, labels_target, dense_to_sparse(ious, min_iou), thresholds)
 
-    for i in range(0, n):
-        iou, j = ious[i].max(0)
-        iou = iou.item()
 
-        if iou > threshold:
-            ious[:, j] = 0  # mark target overlaps to 0 so they won't be selected twice
-            if labels_pred[i] == labels_target[j]:
-                matches[i] = 1
+def _match_positives(labels_pred, labels_target, ious, threshold=0.5):
+    return match_greedy(labels_pred, labels_target, ious, [threshold])[0]
 
-    return matches
 
+def match_thresholds(detections, target, thresholds):
+    assert detections.label.dim() == 1 and target.label.dim() == 1
+    n, m = detections._size, target._size
+
+    if m == 0 or n == 0 or len(thresholds) == 0:
+        return torch.FloatTensor(len(thresholds), n).zero_()
 
+    ious = sparse_ious(detections, target, min_iou=min(thresholds))
+    return match_sparse(detections.label, target.label, ious, thresholds)
 
-def match_positives(detections, target):
+
+def match_positives(detections, target, min_iou=min_match_iou):
+    """ Prepare matching of detections and targets, keeping only the sparse ious above min_iou,
+        returns a function matching at a given threshold (lower thresholds are computed on demand).
+    """
     assert detections.label.dim() == 1 and target.label.dim() == 1
     n, m = detections._size, target._size
 
     if m == 0 or n == 0:
         return const(torch.FloatTensor(n).zero_())
 
-    ious = box.iou_matrix(detections.bbox, target.bbox)
-    return lambda threshold: _match_positives(detections.label, target.label, ious, threshold=threshold)
+    ious = sparse_ious(detections, target, min_iou=min_iou)
+
+    def f(threshold):
+        sparse = ious if threshold >= min_iou else sparse_ious(detections, target, min_iou=threshold)
+        return match_sparse(detections.label, target.label, sparse, [threshold])[0]
+    return f
 
 def list_subset(xs, inds):
     return [xs[i] for i in inds]
 
 
+def threshold_matches(image_pairs, thresholds=(), key='detections'):
+    """ Matches of all image pairs (concatenated) computed in one pass for a set of iou thresholds,
+        thresholds outside of the set are matched on demand.
+    """
+    thresholds = list(thresholds)
+
+    def match_all(thresholds):
+        matches = [match_thresholds(i[key], i.target, thresholds) for i in image_pairs]
+        return torch.cat(matches, 1) if len(matches) > 0 else torch.FloatTensor(len(thresholds), 0)
+
+    matches = match_all(thresholds)
+
+    def f(threshold):
+        if threshold in thresholds:
+            return matches[thresholds.index(threshold)]
+
+        return match_all([threshold])[0]
+    return f
+
+
 def mAP_subset(image_pairs, iou):
     all_matches =  [match_positives(i.prediction, i.target)(iou) for i in image_pairs]
 
@@ -165,16 +320,16 @@ def mAP_subset(image_pairs, iou):
     return f
 
 
-def mAP_weighted(image_pairs):
+def mAP_weighted(image_pairs, thresholds=()):
     confidence    = torch.cat([i.prediction.confidence for i in image_pairs]).float()
     confidence, order = confidence.sort(0, descending=True)    
 
-    matchers =  [match_positives(i.prediction, i.target) for i in image_pairs]
+    matcher = threshold_matches(image_pairs, thresholds, key='prediction')
     predicted_label = torch.cat([i.prediction.label for i in image_pairs])[order]
     image_counts = torch.FloatTensor([i.target.label.size(0) for i in image_pairs])
 
     def f(threshold, image_weights):  
-        matches = torch.cat([match(threshold) for match in matchers])[order]
+        matches = matcher(threshold)[order]
 
         def eval_weight(weight):
             assert weight.size(0) == len(image_pairs)
@@ -193,9 +348,9 @@ def gaussian_weights(xs, x_eval, sigma):
     return torch.exp(-dx2 / (2*sigma*sigma)) / (math.sqrt(2*math.pi) * sigma)        
 
 
-def mAP_smoothed(image_pairs, xs):
+def mAP_smoothed(image_pairs, xs, thresholds=()):
     assert len(image_pairs) == xs.size(0)
-    weighted_mAP = mAP_weighted(image_pairs)
+    weighted_mAP = mAP_weighted(image_pairs, thresholds)
 
     def f(threshold, x_eval, sigma):
         weights = gaussian_weights(xs, x_eval, sigma)
@@ -204,11 +359,11 @@ def mAP_smoothed(image_pairs, xs):
     return f
 
 
-def mAP_classes(image_pairs, num_classes):
+def mAP_classes(image_pairs, num_classes, thresholds=()):
     confidence    = torch.cat([i.detections.confidence for i in image_pairs]).float()
     confidence, order = confidence.sort(0, descending=True)    
 
-    matchers =  [match_positives(i.detections, i.target) for i in image_pairs]
+    matcher = threshold_matches(image_pairs, thresholds, key='detections')
 
     predicted_label = torch.cat([i.detections.label for i in image_pairs])[order]
     target_label = torch.cat([i.target.label for i in image_pairs])
@@ -217,7 +372,7 @@ def mAP_classes(image_pairs, num_classes):
     
     def f(threshold):      
 
-        matches = torch.cat([match(threshold) for match in matchers])[order]
+        matches = matcher(threshold)[order]
         def compute_class(i):
             inds = [(predicted_label == i).nonzero(as_tuple=False).squeeze(1)]
             return compute_mAP(matches[inds], confidence[inds].cpu(), num_targets[i].item())
@@ -229,3 +384,56 @@ def mAP_classes(image_pairs, num_classes):
 
     return f
 
+
+
+class MatchAccumulator:
+    """ Accumulates per image matches for a fixed set of iou thresholds, 
+        pr curves for all classes and thresholds are computed from a single global sort.
+    """
+    def __init__(self, num_classes, thresholds):
+        self.num_classes = num_classes
+        self.thresholds = list(thresholds)
+
+        self.confidence = []
+        self.label = []
+        self.matches = []
+
+        self.num_targets = torch.LongTensor(num_classes).zero_()
+
+    def add(self, confidence, label, matches, target_label):
+        assert matches.size() == torch.Size([len(self.thresholds), confidence.size(0)])
+
+        self.confidence.append(confidence.float().cpu())
+        self.label.append(label.cpu())
+        self.matches.append(matches.cpu().bool())
+
+        self.num_targets += torch.bincount(target_label.cpu(), minlength=self.num_classes)
+
+    def add_image(self, detections, target):
+        matches = match_thresholds(detections, target, self.thresholds)
+        self.add(detections.confidence, detections.label, matches, target.label)
+
+    def sorted(self):
+        """ All accumulated matches sorted by confidence """
+        confidence = torch.cat(self.confidence) if len(self.confidence) > 0 else torch.FloatTensor(0)
+        label = torch.cat(self.label) if len(self.label) > 0 else torch.LongTensor(0)
+        matches = torch.cat(self.matches, 1) if len(self.matches) > 0 \
+            else torch.BoolTensor(len(self.thresholds), 0)
+
+        confidence, order = confidence.sort(dim=0, descending=True, stable=True)
+        return confidence, label[order], matches[:, order]
+
+    def compute(self):
+        """ Returns pr curves for each threshold, in total and for each class
+            struct(total = [pr], classes = [[pr]])
+        """
+        confidence, label, matches = self.sorted()
+
+        def compute_class(i):
+            inds = (label == i).nonzero(as_tuple=False).squeeze(1)
+            return compute_mAPs(matches[:, inds], confidence[inds], self.num_targets[i].item())
+
+        return struct(
+            total = compute_mAPs(matches, confidence, self.num_targets.sum().item()),
+            classes = [compute_class(i) for i in range(0, self.num_classes)]
+        )
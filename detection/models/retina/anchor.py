@@ -1,6 +1,8 @@
 import math
+from collections import OrderedDict
 
 import torch
+from torch.nn.utils.rnn import pad_sequence
 from tools import struct, Table, shape
 
 from detection import box
@@ -22,13 +24,66 @@ def make_boxes(box_sizes, box_dim, device=torch.device('cpu')):
 
 
 def crop_anchors(boxes, image_dim):
-    return box.extents_form(clamp(box.point_form(boxes), (0, 0), image_dim))    
+    return box.extents_form(box.clamp(box.point_form(boxes), (0, 0), image_dim))    
 
 def make_anchors(box_sizes, layer_dims, device=torch.device('cpu')):
     boxes = [make_boxes(boxes, box_dim, device) for boxes, box_dim in zip(box_sizes, layer_dims)]
     return torch.cat(boxes, 0)
 
 
+def layer_size(input_size, i):
+    stride = 2 ** i
+    return (stride, max(1, math.ceil(input_size[0] / stride)), max(1, math.ceil(input_size[1] / stride)))
+
+
+class AnchorCache:
+    """ Bounded LRU cache of anchor boxes per (box sizes, input size, device), shared between encoders.
+        The grid for each pyramid level is generated lazily at the largest size requested so far, 
+        anchors for smaller sizes are sliced from it rather than regenerated.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+
+        self.entries = OrderedDict()
+        self.grids = {}
+
+    def layer_grid(self, box_sizes, layer_dim, device):
+        stride, w, h = layer_dim
+        key = (box_sizes, stride, str(device))
+
+        grid = self.grids.get(key)
+        if grid is None or grid.size(0) < h or grid.size(1) < w:
+            gw, gh = (w, h) if grid is None else (max(w, grid.size(1)), max(h, grid.size(0)))
+            grid = make_boxes(box_sizes, (stride, gw, gh), device).view(gh, gw, len(box_sizes), 4)
+            self.grids[key] = grid
+
+        return grid[:h, :w].reshape(-1, 4)
+
+    def anchors(self, box_sizes, start_layer, input_size, crop_boxes=False, device=torch.device('cpu')):
+        box_sizes = tuple(tuple(map(tuple, sizes)) for sizes in box_sizes)
+        key = (box_sizes, start_layer, tuple(input_size), crop_boxes, str(device))
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
+
+        layers = [self.layer_grid(sizes, layer_size(input_size, start_layer + i), device) 
+            for i, sizes in enumerate(box_sizes)]
+
+        anchors = torch.cat(layers, 0)
+        if crop_boxes:
+            anchors = crop_anchors(anchors, input_size)
+
+        self.entries[key] = anchors
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return anchors
+
+
+anchor_cache = AnchorCache()
+
+
 def anchor_sizes(size, aspects, scales):
     def anchor(s, ar):
         return (s * math.sqrt(ar), s / math.sqrt(ar))
@@ -36,6 +91,29 @@ def anchor_sizes(size, aspects, scales):
     return [anchor(size * scale, ar) for scale in scales for ar in aspects]
 
 
+def match_anchors(anchor_boxes, bbox, top_anchors=0):
+    """ Match anchor boxes [..., n, 4] (extents form) to target boxes [..., m, 4], returns max_ious, max_ids [..., n].
+        Equivalent to doubling the iou of the top_anchors for each target, then taking the maximum over targets,
+        computed with fused reductions (box.iou_reduce) rather than the full iou matrix.
+    """
+    r = box.iou_reduce(box.point_form(anchor_boxes), bbox, top_k=top_anchors)
+    if top_anchors == 0:
+        return r.max_ious, r.max_ids
+
+    m = bbox.size(-2)
+    top_ious, top_ids = r.top_ious.mul(2).flatten(-2), r.top_ids.flatten(-2)
+    columns = torch.arange(m, device=bbox.device).repeat(r.top_ids.size(-2)).expand_as(top_ids)
+
+    top_max = r.max_ious.new_full(r.max_ious.shape, -1).scatter_reduce(-1, top_ids, top_ious, 'amax')
+    first = torch.where(top_ious == top_max.gather(-1, top_ids), columns, m)
+    top_max_ids = r.max_ids.new_full(r.max_ids.shape, m).scatter_reduce(-1, top_ids, first, 'amin')
+
+    max_ids = torch.where(top_max > r.max_ious, top_max_ids, 
+        torch.where(top_max == r.max_ious, torch.min(r.max_ids, top_max_ids), r.max_ids))
+
+    return torch.max(r.max_ious, top_max), max_ids
+
+
 def encode(target, anchor_boxes, params):
     n = anchor_boxes.size(0)
     m = target.bbox.size(0)
@@ -45,13 +123,7 @@ def encode(target, anchor_boxes, params):
         classification  = target.bbox.new_zeros(n, dtype=torch.long)
     )
 
-    ious = box.iou_matrix(box.point_form(anchor_boxes), target.bbox)
-
-    if params.top_anchors > 0:
-        top_ious, inds = ious.topk(params.top_anchors, dim = 0)
-        ious = ious.scatter(0, inds, top_ious * 2)
-
-    max_ious, max_ids = ious.max(1)
+    max_ious, max_ids = match_anchors(anchor_boxes, target.bbox, params.top_anchors)
 
     class_target = encode_classes(target.label, max_ious, max_ids, 
         match_thresholds=params.match_thresholds)
@@ -65,6 +137,39 @@ def encode(target, anchor_boxes, params):
     return struct (location  = location, classification = class_target)
 
 
+def encode_batch(targets, anchor_boxes, params):
+    """ Encode a list of targets against the same anchor boxes, targets are padded to a common size
+        so matching for the whole batch is one iou computation [b, n, m] with vectorized top-k and thresholds.
+        Returns a struct of location [b, n, 4] and classification [b, n] as stack_tables(encode(...)).
+    """
+    n, b = anchor_boxes.size(0), len(targets)
+
+    lengths = torch.tensor([t.bbox.size(0) for t in targets], device=anchor_boxes.device)
+    m = max(lengths.tolist(), default=0)
+
+    if m == 0: return struct (
+        location        = anchor_boxes.new_zeros(b, n, 4), 
+        classification  = anchor_boxes.new_zeros(b, n, dtype=torch.long)
+    )
+
+    bbox = pad_sequence([t.bbox for t in targets], batch_first=True)
+    label = pad_sequence([t.label for t in targets], batch_first=True)
+
+    # padding boxes are empty (zero iou), ties are resolved to the first (real) target
+    max_ious, max_ids = match_anchors(anchor_boxes.unsqueeze(0), bbox, params.top_anchors)
+    max_ids = max_ids + (torch.arange(b, device=bbox.device) * m).unsqueeze(1)
+
+    class_target = encode_classes(label.view(-1), max_ious, max_ids, 
+        match_thresholds=params.match_thresholds)
+
+    location = bbox.view(-1, 4)[max_ids]
+    if params.location_loss == "l1":
+        location = encode_boxes(location, anchor_boxes) 
+
+    location = location.masked_fill_((lengths == 0).view(b, 1, 1), 0)
+    return struct (location  = location, classification = class_target)
+
+
 def encode_classes(label, max_ious, max_ids, match_thresholds=(0.4, 0.5)):
 
     match_neg, match_pos = match_thresholds
@@ -89,7 +194,7 @@ def encode_boxes(boxes, anchor_boxes):
 
     loc_pos = (boxes_pos - anchor_pos) / anchor_size
     loc_size = torch.log(boxes_size/anchor_size)
-    return torch.cat([loc_pos,loc_size], 1)
+    return torch.cat([loc_pos,loc_size], loc_pos.dim() - 1)
 
 
 def decode(prediction, anchor_boxes):
@@ -113,6 +218,35 @@ def decode(prediction, anchor_boxes):
 
 
 
+def top_candidates(classification, level_sizes, k, per_class=False):
+    """ Select the top k candidates from each pyramid level of classification [B, N, C] (levels of level_sizes anchors),
+        either the top anchors by maximum class score or (per_class) the top (anchor, class) pairs.
+        Returns struct of confidence, anchor index and label each of shape [B, K].
+    """
+    batch, n, num_classes = classification.shape
+
+    if per_class:
+        scores, labels = classification.reshape(batch, -1), None
+        sizes = [size * num_classes for size in level_sizes]
+    else:
+        scores, labels = classification.max(2)
+        sizes = level_sizes
+
+    confidence, inds = [], []
+    for offset, level in zip(torch.tensor([0, *sizes]).cumsum(0).tolist(), scores.split(sizes, 1)):
+        level_confidence, level_inds = level.topk(min(k, level.size(1)), dim=1)
+
+        confidence.append(level_confidence)
+        inds.append(level_inds + offset)
+
+    confidence, inds = torch.cat(confidence, 1), torch.cat(inds, 1)
+
+    if per_class:
+        return struct(confidence = confidence, anchor = inds // num_classes, label = inds % num_classes)
+
+    return struct(confidence = confidence, anchor = inds, label = labels.gather(1, inds))
+
+
 def decode_nms(loc_preds, class_preds, anchor_boxes, nms_params):
     assert loc_preds.dim() == 2 and class_preds.dim() == 2
 
@@ -23,9 +23,7 @@ from . import anchor, loss
 
 
 class Encoder:
-    def __init__(self, start_layer, box_sizes, class_weights, params, device = torch.device('cpu')):
-        self.anchor_cache = {}
-
+    def __init__(self, start_layer, box_sizes, class_weights, params, device = torch.device('cpu'), encode_workers=False):
         self.box_sizes = box_sizes
         self.start_layer = start_layer
 
@@ -33,56 +31,83 @@ class Encoder:
         self.params = params
         self.device = device
 
+        self.encode_workers = encode_workers
+
     def to(self, device):
         self.device = device
-        self.anchor_cache = {k: anchors.to(device) 
-            for k, anchors in self.anchor_cache.items()}
 
         return self
 
     def anchors(self, input_size):
+        return anchor.anchor_cache.anchors(self.box_sizes, self.start_layer, input_size, 
+            crop_boxes=self.params.crop_boxes, device=self.device)
+
+    def encode(self, inputs, target):
+        if not self.encode_workers:
+            return struct()
 
-        def layer_size(i):
-            stride = 2 ** i
-            return (stride, max(1, math.ceil(input_size[0] / stride)), max(1, math.ceil(input_size[1] / stride)))
+        input_size = image_size(inputs)
+        encoding = anchor.encode_batch([target], self.anchors(input_size), self.params)
+        return encoding._map(lambda t: t[0])._extend(input_size = torch.LongTensor(input_size))
 
-        input_args = (input_size, self.params.crop_boxes)
+    def encode_batch(self, inputs, targets):
+        if not self.encode_workers:
+            return struct()
 
-        if not (input_args in self.anchor_cache):
-            
-            layer_dims = [layer_size(self.start_layer + i) for i in range(0, len(self.box_sizes))]
-            anchors = anchor.make_anchors(self.box_sizes, layer_dims, device=self.device)
-            if self.params.crop_boxes:
-                anchors = anchor.crop_anchors(anchors, input_size)
-            self.anchor_cache[input_args] = anchors
+        input_size = image_size(inputs)
+        encoding = anchor.encode_batch(targets, self.anchors(input_size), self.params)
+        return encoding._extend(input_size = torch.LongTensor([input_size] * len(targets)))
 
-        return self.anchor_cache[input_args]
+    def encoding(self, input_size, target, encoding):
+        """ Use the pre-computed encoding where available (and computed for this input size), 
+            otherwise encode the batch of targets """
+        if 'input_size' in encoding and (encoding.input_size.cpu() == torch.LongTensor(input_size)).all():
+            return encoding
 
-    def encode(self, inputs, target):
-        return struct()
+        return anchor.encode_batch(target, self.anchors(input_size), self.params)
         
     def decode(self, input_size, prediction, nms_params=detection_table.nms_defaults):
         classification, location = prediction
-        location.dim() == 2 and classification.dim() == 2
+        assert location.dim() == 2 and classification.dim() == 2
+
+        prediction = (classification.unsqueeze(0), location.unsqueeze(0))
+        return self.decode_batch(input_size, prediction, nms_params=nms_params)[0]
+
+
+    def level_sizes(self, input_size):
+        return [w * h * len(sizes) for sizes, (_, w, h) in 
+            zip(self.box_sizes, [anchor.layer_size(input_size, self.start_layer + i) for i in range(len(self.box_sizes))])]
+
+    def decode_batch(self, input_size, prediction, nms_params=detection_table.nms_defaults):
+        """ Decode a batch of predictions [B, N, C], [B, N, 4] to a list of detection tables, 
+            only the top candidates of each pyramid level are decoded """
+        classification, location = prediction
+        assert location.dim() == 3 and classification.dim() == 3
+
+        nms_params = detection_table.nms_defaults._merge(nms_params)
 
+        batch_size = location.size(0)
         anchor_boxes = self.anchors(input_size)
 
-        bbox = anchor.decode(location, anchor_boxes)
-        confidence, label = classification.max(1)
+        candidates = anchor.top_candidates(classification, self.level_sizes(input_size), 
+            nms_params.candidates, per_class=nms_params.per_class)
+
+        inds = candidates.anchor
+        location = location.gather(1, inds.unsqueeze(2).expand(*inds.shape, 4))
+        bbox = anchor.decode(location, anchor_boxes[inds])
 
         if self.params.crop_boxes:
-            box.clamp(bbox, (0, 0), inputs)
+            box.clamp(bbox.view(-1, 4), (0, 0), input_size)
 
-        decoded = table(bbox = bbox, confidence = confidence, label = label)
-        return detection_table.nms(decoded, nms_params)
+        decoded = table(bbox = bbox.view(-1, 4), confidence = candidates.confidence.view(-1), label = candidates.label.view(-1))
+        return detection_table.nms_batch(decoded, batch_size, nms_params, index = inds.view(-1))
 
        
     def loss(self, input_size, target, encoding, prediction):
         classification, location = prediction
 
         anchor_boxes = self.anchors(input_size)      
-        encoding = stack_tables([anchor.encode(t, anchor_boxes, self.params) for t in target])
-        # target = tensors_to(encoding, device=prediction.location.device)
+        encoding = self.encoding(input_size, target, encoding)
 
         class_loss = loss.class_loss(encoding.classification, classification,  class_weights=self.class_weights)
         loc_loss = 0
@@ -1,15 +1,14 @@
 import sys
 import math
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
 
-import numpy as np
-
 from detection import box, display, detection_table
-from tools import struct, table, shape, sum_list, cat_tables, shape
+from tools import struct, table, shape, sum_list, cat_tables, shape, split_table
 
 from tools import image
 
@@ -37,28 +36,44 @@ def show_heatmap(prediction, colours):
     return heatmap
 
 
-def make_centres(w, h, device):               
-    x = torch.arange(0, w, device=device, dtype=torch.float).add_(0.5)
-    y = torch.arange(0, h, device=device, dtype=torch.float).add_(0.5)
+def make_centres(w, h, stride, device, dtype=torch.float):
+    """ Centres of each heatmap cell [H, W, 2] in input coordinates (scaled by stride) """
+    x = torch.arange(0, w, device=device, dtype=dtype).add_(0.5).mul_(stride)
+    y = torch.arange(0, h, device=device, dtype=dtype).add_(0.5).mul_(stride)
+
+    return torch.stack([x.view(1, w).expand(h, w), y.view(h, 1).expand(h, w)], dim=2)
+
+
+class CentreCache:
+    """ Bounded LRU cache of centre grids per (size, stride, device, dtype), shared between encoders """
+    def __init__(self, max_entries=16):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def centres(self, w, h, stride=1, device=torch.device('cpu'), dtype=torch.float):
+        key = (w, h, stride, str(device), dtype)
 
-    return torch.stack(torch.meshgrid(x, y), dim=2).permute(1, 0, 2)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.entries[key]
 
-def expand_centres(centres, input_size, device):
-    w, h = max(1, math.ceil(input_size[0])), max(1, math.ceil(input_size[1]))
-    ch, cw, _ = centres.shape
+        centres = make_centres(w, h, stride, device, dtype)
+
+        self.entries[key] = centres
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
 
-    if ch < h or cw < w: 
-        return make_centres(max(w, cw), max(h, ch), device=device)
-    else:
         return centres
 
 
+centre_cache = CentreCache()
+
 
 
 def show_local_maxima(classification, kernel=3):
     maxima, mask = local_maxima(classification)
-    maxima = maxima.max(dim=0).values.unsqueeze(2)
-    alpha  = mask.max(dim=0).values.float().unsqueeze(2)
+    maxima = maxima.max(dim=2).values.unsqueeze(2)
+    alpha  = mask.max(dim=2).values.float().unsqueeze(2)
 
     colour = (1 - maxima) * maxima.new_tensor([1, 0, 0]) + maxima * maxima.new_tensor([0, 1, 0])
     return torch.cat([colour, alpha], dim=2)
@@ -66,57 +81,90 @@ def show_local_maxima(classification, kernel=3):
 
 
 def local_maxima(classification, kernel=3, threshold=0.05):
-    classification = classification.permute(2, 0, 1).contiguous()
+    maxima, mask = local_maxima_batch(classification.unsqueeze(0), kernel=kernel, threshold=threshold)
+    return maxima[0], mask[0]
+
+
+def decode(classification, boxes, kernel=3, nms_params=detection_table.nms_defaults):
+    """ Decode a heatmap [H, W, C] and boxes [H, W, 4] to a detection table (as decode_batch, synchronises with the host) """
+    return decode_batch(classification.unsqueeze(0), boxes.unsqueeze(0), kernel=kernel, nms_params=nms_params)[0]
+
+
+def local_maxima_batch(classification, kernel=3, threshold=0.05):
+    """ Local maxima of heatmaps [B, H, W, C], pooled as a channels last view (no copy), 
+        returns maxima (zero elsewhere) and mask both [B, H, W, C] """
+    classification = classification.permute(0, 3, 1, 2)
 
     maxima = F.max_pool2d(classification, (kernel, kernel), stride=1, padding=(kernel - 1) // 2)
     mask = (maxima == classification) & (maxima >= threshold)
     
-    return maxima.masked_fill_(~mask, 0.), mask
+    return maxima.masked_fill_(~mask, 0.).permute(0, 2, 3, 1), mask.permute(0, 2, 3, 1)
 
 
-def decode(classification, boxes, kernel=3, nms_params=detection_table.nms_defaults):
-    h, w, num_classes = classification.shape
-    maxima, mask = local_maxima(classification, kernel=kernel, threshold=nms_params.threshold)
+def decode_padded(classification, boxes, kernel=3, nms_params=detection_table.nms_defaults):
+    """ Decode a batch of heatmaps [B, H, W, C] and boxes [B, H, W, 4] to a fixed number of detections k 
+        for each image, table of [B, k] where entries below threshold have zero confidence and valid = False.
+        Sizes depend only on input shapes (no host synchronisation) so it can be traced or captured in a cuda graph. """
+    batch, h, w, num_classes = classification.shape
+    maxima, mask = local_maxima_batch(classification, kernel=kernel, threshold=nms_params.threshold)
 
-    confidence, inds = maxima.view(-1).topk(k = min(nms_params.detections, mask.sum()), dim=0)
+    k = min(nms_params.detections, h * w * num_classes)
+    confidence, inds = maxima.reshape(batch, -1).topk(k = k, dim=1)
 
-    labels   = inds // (h * w)
-    box_inds = inds % (h * w)
-    
-    return table(label = labels, bbox = boxes.view(-1, 4)[box_inds], confidence=confidence)
+    valid = mask.reshape(batch, -1).gather(1, inds)
 
-def decode_boxes(centres, prediction, stride):
-    lower, upper = box.split(prediction)
-    return box.join(centres - lower, centres + upper) * stride
+    box_inds = inds // num_classes
+    bbox = boxes.reshape(batch, -1, 4).gather(1, box_inds.unsqueeze(2).expand(batch, k, 4))
+
+    return table(label = inds % num_classes, bbox = bbox, confidence = confidence, valid = valid)
+
+
+def decode_batch(classification, boxes, kernel=3, nms_params=detection_table.nms_defaults):
+    """ Decode a batch of heatmaps [B, H, W, C] and boxes [B, H, W, 4] to a list of detection tables,
+        compacting the result of decode_padded (one host synchronisation per batch for the counts). """
+    decoded = decode_padded(classification, boxes, kernel=kernel, nms_params=nms_params)
+    valid = decoded.valid
+
+    detections = table(label = decoded.label[valid], bbox = decoded.bbox[valid], confidence = decoded.confidence[valid])
+    return split_table(detections, valid.sum(1).tolist())
 
 
-def gaussian_2d(shape, sigma_x=1, sigma_y=1):
-    m, n = [(ss - 1.) / 2. for ss in shape]
-    y, x = np.ogrid[-m:m + 1, -n:n + 1]
+def decode_boxes(centres, prediction, stride):
+    """ Boxes from (stride scaled) centres [H, W, 2] and distances to each side [..., H, W, 4] """
+    lower, upper = box.split(prediction * stride)
+    return box.join(centres - lower, centres + upper)
 
-    h = np.exp(-(x * x / (2 * sigma_x * sigma_x) + y * y / (2 * sigma_y * sigma_y)))
-    h[h < np.finfo(h.dtype).eps * h.max()] = 0
-    return h
 
-def clipped_gaussian(image_size, extents, alpha):
+def box_windows(bbox, heatmap_size, alpha):
+    """ Pixels covered by the (clipped) gaussian window of each box, 
+        returns box index, pixel coordinates and gaussian value for every (box, pixel) pair. """
+    w, h = heatmap_size
+    extents = box.extents(bbox)
 
     radius = ((extents.size / 2.) * alpha).int()
-    w, h = (radius * 2 + 1).tolist()
-    rw, rh = radius.tolist()
+    centre = extents.centre.int()
 
-    x, y = extents.centre.int().tolist()     
-    gaussian = torch.FloatTensor(gaussian_2d((h, w), sigma_x=w / 6, sigma_y=h / 6))
+    lower = (centre - radius).clamp(min=0)
+    upper = torch.min(centre + radius + 1, radius.new_tensor([w, h]))
 
-    left, right = min(x, rw), min(image_size[0] - x, rw + 1)
-    top, bottom = min(y, rh), min(image_size[1] - y, rh + 1)
-    
-    if x + right > x - left and y + bottom > y - top:
-    
-        slices = [slice(y - top, y + bottom), slice(x - left, x + right)]
-        clipped = gaussian[rh - top:rh + bottom, rw - left:rw + right]
+    size = (upper - lower).clamp(min=0)
+    counts = size[:, 0] * size[:, 1]
+
+    index = torch.arange(bbox.size(0), device=bbox.device).repeat_interleave(counts)
+    offsets = torch.arange(index.size(0), device=bbox.device) - (counts.cumsum(0) - counts)[index]
 
-        return [(clipped, slices)]
-    return []
+    width = size[index, 0]
+    x = lower[index, 0] + offsets % width
+    y = lower[index, 1] + offsets // width
+
+    # gaussian with sigma of 1/6 of the window size, in double precision with negligible values truncated
+    sigma = (radius[index] * 2 + 1).double() / 6
+    dx, dy = (x - centre[index, 0]).double(), (y - centre[index, 1]).double()
+
+    gaussian = torch.exp(-(dx * dx / (2 * sigma[:, 0] * sigma[:, 0]) + dy * dy / (2 * sigma[:, 1] * sigma[:, 1])))
+    gaussian[gaussian < torch.finfo(gaussian.dtype).eps] = 0
+
+    return struct(index = index, x = x.long(), y = y.long(), gaussian = gaussian.to(bbox.dtype))
 
 
 def layer_size(input_size, i):
@@ -127,39 +175,71 @@ def encode_layer(target, input_size, layer,  num_classes, params):
     stride, heatmap_size = layer_size(input_size, layer)
     return encode_target(target._extend(bbox = target.bbox * (1. / stride)), heatmap_size, num_classes, params)
 
+def encode_layer_batch(targets, input_size, layer, num_classes, params):
+    stride, heatmap_size = layer_size(input_size, layer)
+    targets = [target._extend(bbox = target.bbox * (1. / stride)) for target in targets]
+
+    encoded = encode_targets(targets, heatmap_size, num_classes, params)
+    return encoded._extend(box_index = weighted_cells(encoded.box_weight))
+
+
+def weighted_cells(box_weight):
+    """ Flat indexes of cells with non zero box weight (out of B * H * W), the only cells contributing to the giou loss """
+    return box_weight.view(-1).nonzero(as_tuple=False).squeeze(1)
+
 
 def encode_target(target, heatmap_size, num_classes, params):
+    encoded = encode_targets([target], heatmap_size, num_classes, params)
+    return encoded._map(lambda t: t[0])
 
-    m = target.bbox.size(0)
+
+def encode_targets(targets, heatmap_size, num_classes, params):
+    """ Encode a list of targets (bbox in heatmap coordinates) to batched heatmap [B, H, W, C], 
+        box_target [B, H, W, 4] and box_weight [B, H, W]. All gaussians are rendered at once with a scatter-max,
+        where gaussians overlap the box target is taken from the box with the highest weight (ties to the larger box).
+    """
     w, h = heatmap_size
+    n = len(targets)
+
+    bbox = torch.cat([t.bbox for t in targets])
+    label = torch.cat([t.label for t in targets])
+    image = torch.arange(n, device=bbox.device).repeat_interleave(bbox.new_tensor([t.label.size(0) for t in targets], dtype=torch.long))
+
+    assert (label < num_classes).all()
 
     # sort by area, largest boxes first (and least priority)
-    areas = box.area(target.bbox)
-    areas, boxes_ind = torch.sort(areas, descending=True)
+    areas = box.area(bbox)
+    areas, boxes_ind = torch.sort(areas, descending=True, stable=True)
+    bbox, label, image = bbox[boxes_ind], label[boxes_ind], image[boxes_ind]
 
-    heatmap = areas.new_zeros(num_classes, h, w)
-    box_weight =  areas.new_zeros(h, w)
-    box_target =  areas.new_zeros(h, w, 4)
-    
-    for (label, target_box) in zip(target.label[boxes_ind], target.bbox[boxes_ind]):
-        assert label < num_classes
+    heatmap = areas.new_zeros(n * num_classes * h * w)
+    box_weight = areas.new_zeros(n * h * w)
+    box_target = areas.new_zeros(n * h * w, 4)
+
+    window = box_windows(bbox, heatmap_size, params.alpha)
+    pixel = (image[window.index] * h + window.y) * w + window.x
+
+    heatmap_pixel = ((image[window.index] * num_classes + label[window.index]) * h + window.y) * w + window.x
+    heatmap.scatter_reduce_(0, heatmap_pixel, window.gaussian, 'amax')
 
-        extents = box.extents(target_box)
-        area = extents.size.dot(extents.size)
+    size = box.extents(bbox).size
+    sums = areas.new_zeros(bbox.size(0)).index_add_(0, window.index, window.gaussian)
+    scale = (size * size).sum(1).log() / sums
 
-        for gaussian, slices in clipped_gaussian(heatmap_size, extents, params.alpha):
-            gaussian = gaussian.type_as(heatmap) 
+    loc_weight = window.gaussian * scale[window.index]
+    box_weight.scatter_reduce_(0, pixel, loc_weight, 'amax')
 
-            local_heatmap = heatmap[label][slices]
-            torch.max(gaussian, local_heatmap, out=local_heatmap)
-            
-            loc_weight = gaussian * (area.log() / gaussian.sum())
+    # first box (in order of decreasing area) which has the maximum weight, for each pixel
+    best = (loc_weight == box_weight[pixel]) & (loc_weight > 0)
+    winner = pixel.new_full((n * h * w,), bbox.size(0)).scatter_reduce_(0, pixel[best], window.index[best], 'amin')
 
-            mask = loc_weight > box_weight[slices]
-            box_target[slices][mask] = target_box
-            box_weight[slices][mask] = loc_weight[mask]
+    assigned = winner < bbox.size(0)
+    box_target[assigned] = bbox[winner[assigned]]
 
-    return struct(heatmap=heatmap.permute(1, 2, 0), box_target=box_target, box_weight=box_weight)
+    return struct(
+        heatmap = heatmap.view(n, num_classes, h, w).permute(0, 2, 3, 1), 
+        box_target = box_target.view(n, h, w, 4), 
+        box_weight = box_weight.view(n, h, w))
 
 
 
@@ -1,11 +1,14 @@
 import torch
+from torch.utils.checkpoint import checkpoint
+
 from detection import box
 
 
-def class_loss(target, prediction, class_weights):
+def class_loss(target, prediction, class_weights, eps=1e-6):
     """
     Focal loss variant of BCE as used in CornerNet and CenterNet.
     """
+    prediction = prediction.float().clamp(min=eps, max=1-eps)
 
     # As per RetinaNet focal loss - if heatmap == 1
     pos_loss = -prediction.log() * (1 - prediction).pow(2)
@@ -20,4 +23,36 @@ def giou(target, prediction, weight):
     assert target.shape == prediction.shape, str(target.shape) + " vs. " + str(prediction.shape)
 
     giou = box.giou(prediction.view(-1, 4), target.view(-1, 4))
-    return (1 - giou).mul_(weight.view(-1)).sum()
\ No newline at end of file
+    return (1 - giou).mul_(weight.view(-1)).sum()
+
+
+def giou_components(centres, location, target, weight):
+    lower, upper = box.split(location)
+    target_lower, target_upper = box.split(target)
+
+    pred_lower, pred_upper = centres - lower, centres + upper
+
+    inter = (torch.min(pred_upper, target_upper) - torch.max(pred_lower, target_lower)).clamp(min=0).prod(-1)
+    hull = (torch.max(pred_upper, target_upper) - torch.min(pred_lower, target_lower)).prod(-1)
+
+    unions = (lower + upper).prod(-1) + (target_upper - target_lower).prod(-1) - inter
+
+    giou = box.conditional_div(inter, unions) - box.conditional_div(hull - unions, hull)
+    return (1 - giou).mul_(weight).sum()
+
+
+def decode_giou(centres, location, target, weight, index=None):
+    """ As giou, on boxes decoded from centres [H, W, 2] and location [B, H, W, 4] in one step.
+        If given a flat index of cells with non zero weight, giou is computed only for those cells, 
+        otherwise intermediates per cell are recomputed in the backward pass rather than stored. """
+    assert target.shape == location.shape, str(target.shape) + " vs. " + str(location.shape)
+
+    if index is not None:
+        cells = index % (centres.size(0) * centres.size(1))
+        return giou_components(centres.view(-1, 2)[cells], location.view(-1, 4)[index], 
+            target.view(-1, 4)[index], weight.view(-1)[index])
+
+    if not torch.is_grad_enabled():
+        return giou_components(centres, location, target, weight)
+
+    return checkpoint(giou_components, centres, location, target, weight, use_reentrant=False)
@@ -29,42 +29,63 @@ from . import encoding, loss
 
 class Encoder:
     def __init__(self, layer, class_weights, params, device = torch.device('cpu'), dtype=torch.float):
-        self.centre_map = torch.FloatTensor(0, 0, 2).to(device)
-
         self.layer = layer
         self.stride =  stride = 2 ** layer
         self.class_weights = class_weights
 
         self.params = params
         self.device = device
+        self.dtype = dtype
 
     def to(self, device, dtype=torch.float):
         self.device = device
         self.dtype = dtype
-
-        self.centre_map = self.centre_map.to(device, dtype=self.dtype)
         return self
 
-    def _centres(self, w, h):
-
-        self.centre_map = encoding.expand_centres(self.centre_map, (w, h), device=self.device)
-        return self.centre_map[:h, :w]
+    def _centres(self, w, h, stride):
+        return encoding.centre_cache.centres(w, h, stride, device=self.device, dtype=self.dtype)
 
     def encode(self, inputs, target):
         input_size = image_size(inputs)
         num_classes = len(self.class_weights)
         return encoding.encode_layer(target, input_size, self.layer, num_classes, self.params) 
 
+    def encode_batch(self, inputs, targets):
+        input_size = image_size(inputs)
+        num_classes = len(self.class_weights)
+        return encoding.encode_layer_batch(targets, input_size, self.layer, num_classes, self.params) 
+
 
     def decode(self, input_size, prediction, nms_params=detection_table.nms_defaults):
         (classification, location) = prediction
 
         h, w, _ = classification.shape
-        centres = self._centres(w, h)
+        centres = self._centres(w, h, self.stride)
         
         boxes = encoding.decode_boxes(centres, location, self.stride)
         return encoding.decode(classification, boxes, nms_params=nms_params)
 
+    def decode_batch(self, input_size, prediction, nms_params=detection_table.nms_defaults):
+        """ Decode a batch of predictions [B, H, W, C], [B, H, W, 4] to a list of detection tables,
+            variable length tables need the counts on the host, decode_padded avoids synchronising """
+        (classification, location) = prediction
+
+        _, h, w, _ = classification.shape
+        centres = self._centres(w, h, self.stride)
+        
+        boxes = encoding.decode_boxes(centres, location, self.stride)
+        return encoding.decode_batch(classification, boxes, nms_params=nms_params)
+
+    def decode_padded(self, input_size, prediction, nms_params=detection_table.nms_defaults):
+        """ As decode_batch but returns a fixed size table [B, k] with a valid mask, without host synchronisation """
+        (classification, location) = prediction
+
+        _, h, w, _ = classification.shape
+        centres = self._centres(w, h, self.stride)
+        
+        boxes = encoding.decode_boxes(centres, location, self.stride)
+        return encoding.decode_padded(classification, boxes, nms_params=nms_params)
+
     @property
     def debug_keys(self):
         return ["heatmap", "maxima", "heatmap_target", "target_weight"]
@@ -91,10 +112,11 @@ class Encoder:
         batch, h, w, num_classes = classification.shape
           
         class_loss = loss.class_loss(encoded_target.heatmap, classification,  class_weights=self.class_weights)
-        centres = self._centres(w, h).unsqueeze(0).expand(batch, h, w, -1)
-                     
-        box_prediction = encoding.decode_boxes(centres, location, 1)
-        loc_loss = loss.giou(encoded_target.box_target, box_prediction, encoded_target.box_weight)
+        centres = self._centres(w, h, 1)
+        box_index = encoded_target.box_index if 'box_index' in encoded_target \
+            else encoding.weighted_cells(encoded_target.box_weight)
+
+        loc_loss = loss.decode_giou(centres, location, encoded_target.box_target, encoded_target.box_weight, index=box_index)
 
         return struct(classification = class_loss / self.params.balance, location = loc_loss)
     
@@ -0,0 +1,55 @@
+import torch
+from detection import box
+
+# Score decaying variants of nms on a fixed number of candidates per image [B, K] (sorted by descending score),
+# using only tensor operations with a fixed amount of work, so they run on the device without host synchronisation.
+
+
+def candidate_ious(bbox, label=None):
+    """ Iou matrix [B, K, K] between candidates of each image, (optionally) only between those of the same label """
+    ious = box.iou_matrix(bbox, bbox)
+    if label is not None:
+        ious = ious * (label.unsqueeze(2) == label.unsqueeze(1))
+
+    return ious
+
+
+def matrix_nms(ious, scores, sigma=0.5):
+    """ Matrix nms (SOLOv2), decays each score by its overlap with every higher scoring candidate,
+        compensated by how much that candidate was itself suppressed. All candidates in parallel.
+    Args:
+        ious: (tensor) candidate ious, Shape: [B, K, K]
+        scores: (tensor) candidate scores sorted descending, Shape: [B, K]
+    Return:
+        decayed scores, Shape: [B, K]
+    """
+    if scores.size(1) == 0:
+        return scores
+
+    ious = ious.triu(diagonal=1)
+    compensate = ious.max(1).values.unsqueeze(2)
+
+    decay = torch.exp(-(ious.pow(2) - compensate.pow(2)) / sigma)
+    return scores * decay.min(1).values
+
+
+def soft_nms(ious, scores, k, sigma=0.5):
+    """ Gaussian soft-nms, repeatedly selects the highest scoring candidate and decays the scores of those
+        overlapping it, for a fixed number of steps k.
+    Return:
+        indexes of selected candidates and their (decayed) scores, Shape: [B, k]
+    """
+    batch = torch.arange(scores.size(0), device=scores.device)
+    selected = torch.zeros_like(scores, dtype=torch.bool)
+
+    inds = scores.new_zeros((scores.size(0), k), dtype=torch.long)
+    selected_scores = scores.new_zeros((scores.size(0), k))
+
+    for j in range(k):
+        selected_scores[:, j], inds[:, j] = scores.masked_fill(selected, -1).max(1)
+        i = inds[:, j]
+
+        selected[batch, i] = True
+        scores = scores * torch.exp(-ious[batch, i].pow(2) / sigma)
+
+    return inds, selected_scores
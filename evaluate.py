@@ -16,6 +16,7 @@ from tools import struct, tensor, shape, cat_tables, shape_info, \
     Histogram, ZipList, transpose_structs, transpose_lists, pluck, Struct, filter_none, split_table, tensors_to, map_tensors
 
 from detection import box, evaluate, detection_table
+from dataset.detection import pad_images
 from functools import reduce
 
 import operator
@@ -31,8 +32,9 @@ def sum_results(results):
 # TODO: move this entirely to the individual object detector
 def make_statistics(data, encoder, loss, prediction):
 
+    loss = loss._map(Tensor.item)
     stats = struct(error=sum(loss.values()),
-        loss = loss._map(Tensor.item),
+        loss = loss,
         size = data.image.size(0),
         instances=data.lengths.sum().item(),
     )
@@ -41,11 +43,36 @@ def make_statistics(data, encoder, loss, prediction):
 
 
 
-def eval_train(model, encoder, debug = struct(), device=torch.cuda.current_device()):
+default_device = torch.cuda.current_device() if torch.cuda.is_available() else torch.device('cpu')
+
+amp_types = dict(fp16 = torch.float16, bf16 = torch.bfloat16)
+
+def autocast(device, amp='none'):
+    """ Autocast context for mixed precision (amp = none | fp16 | bf16) on the type of device given """
+    assert amp == 'none' or amp in amp_types, "unknown amp type: " + amp
+    return torch.autocast(torch.device(device).type, dtype=amp_types.get(amp), enabled=amp in amp_types)
+
+def grad_scaler(device, amp='none'):
+    """ Gradient scaler, only needed (enabled) for fp16 as bf16 has the range of fp32 """
+    return torch.amp.GradScaler(torch.device(device).type, enabled=amp == 'fp16')
+
+
+def eval_train(model, encoder, debug = struct(), device=default_device, augment=None, amp='none'):
     def f(data):
+        # micro batches (dataset.detection.split_batch) are normalised by the size of the whole batch
+        batch_size = data.batch_size if 'batch_size' in data else data.image.size(0)
+
+        if augment is not None:
+            data = augment(data)
+
         image = data.image.to(device)
         norm_data = normalize_batch(image)
-        prediction = model(norm_data)
+
+        with autocast(device, amp):
+            prediction = model(norm_data)
+
+        # losses are computed in fp32 outside of autocast
+        prediction = map_tensors(prediction, lambda p: p.float())
 
         target_table = tensors_to(data.target, device=device)
         encoding = tensors_to(data.encoding, device=device)
@@ -56,7 +83,7 @@ def eval_train(model, encoder, debug = struct(), device=torch.cuda.current_devic
         loss = encoder.loss(input_size, targets, encoding, prediction)
 
         statistics = make_statistics(data, encoder, loss, prediction)
-        return struct(error = sum(loss.values()) / image.data.size(0), statistics=statistics, size = data.image.size(0))
+        return struct(error = sum(loss.values()) / batch_size, statistics=statistics, size = data.image.size(0))
     return f
 
 
@@ -76,19 +103,48 @@ def summarize_train(name, results, classes, epoch, log):
 
 
 
-def evaluate_image(model, image, encoder, nms_params=detection_table.nms_defaults,  device=torch.cuda.current_device()):
+def clip_detections(detections, image_size):
+    """ Remove detections centred outside of the image and clamp boxes to the image bounds """
+    centre = box.extents(detections.bbox).centre
+    inside = (centre < centre.new_tensor(image_size)).all(1)
+
+    detections = detections._index_select(inside.nonzero(as_tuple=False).squeeze(1))
+    return detections._extend(bbox = box.clamp(detections.bbox.clone(), (0, 0), image_size))
+
+
+def evaluate_batch(model, images, encoder, image_sizes=None, nms_params=detection_table.nms_defaults, device=default_device):
+    """ Evaluate a batch [B,H,W,C] or a list of images [H,W,C] of differing sizes (padded to a common size)
+        with one forward pass. Detections of padded images are clipped to their original image_sizes.
+    """
     model.eval()
     with torch.no_grad():
-        batch = image.unsqueeze(0) if image.dim() == 3 else image          
-        assert batch.dim() == 4, "evaluate: expected image of 4d  [1,H,W,C] or 3d [H,W,C]"
-        input_size = (batch.shape[2], batch.shape[1])
+        if not torch.is_tensor(images):
+            image_sizes = [(image.shape[1], image.shape[0]) for image in images]
+            images = torch.stack(pad_images(images))
+
+        assert images.dim() == 4, "evaluate_batch: expected batch of 4d [B,H,W,C] or list of 3d [H,W,C]"
+        input_size = (images.shape[2], images.shape[1])
+
+        norm_data = normalize_batch(images.to(device)).contiguous()
+        prediction = map_tensors(model(norm_data), lambda p: p.detach())
 
-        norm_data = normalize_batch(batch.to(device)).contiguous()
-        prediction = map_tensors(model(norm_data), lambda p: p.detach()[0])
+        def clip(detections, image_size):
+            return detections if tuple(image_size) == input_size \
+                else clip_detections(detections, tuple(image_size))
 
-        # print(shape(prediction))
+        image_sizes = image_sizes or [input_size] * images.size(0)
+        detections = encoder.decode_batch(input_size, prediction, nms_params=nms_params)
+        detections = [clip(d, image_size) for d, image_size in zip(detections, image_sizes)]
+        
+        return struct(detections = detections, prediction = prediction)
 
-        return struct(detections = encoder.decode(input_size, prediction, nms_params=nms_params), prediction = prediction)
+
+def evaluate_image(model, image, encoder, nms_params=detection_table.nms_defaults,  device=default_device):
+    batch = image.unsqueeze(0) if image.dim() == 3 else image          
+    assert batch.dim() == 4, "evaluate: expected image of 4d  [1,H,W,C] or 3d [H,W,C]"
+
+    result = evaluate_batch(model, batch, encoder, nms_params=nms_params, device=device)
+    return struct(detections = result.detections[0], prediction = map_tensors(result.prediction, lambda p: p[0]))
 
   
 eval_defaults = struct(
@@ -99,21 +155,92 @@ eval_defaults = struct(
     batch_size = 1,
     nms_params = detection_table.nms_defaults,
 
-    device=torch.cuda.current_device(),
+    device=default_device,
     debug = ()
 )  
 
+def split_ranges(length, size, overlap):
+    """ Evenly spaced ranges [start, end) of size covering length, overlapping by at least overlap. 
+        Each range is responsible for detections centred in [lower, upper) split at the middle of overlaps.
+    """
+    if length <= size:
+        return [struct(start = 0, end = length, lower = -math.inf, upper = math.inf)]
+
+    assert size > overlap, "split_ranges: overlap must be smaller than the tile size"
+    n = math.ceil((length - overlap) / (size - overlap))
+
+    starts = [round(i * (length - size) / (n - 1)) for i in range(n)]
+    ends = [start + size for start in starts]
+
+    bounds = [-math.inf] + [(end + start) / 2 for end, start in zip(ends[:-1], starts[1:])] + [math.inf]
+    return [struct(start = start, end = end, lower = lower, upper = upper) 
+        for start, end, lower, upper in zip(starts, ends, bounds[:-1], bounds[1:])]
+
+
+def image_tiles(image_size, tile_size, overlap):
+    xs = split_ranges(image_size[0], tile_size[0], overlap)
+    ys = split_ranges(image_size[1], tile_size[1], overlap)
+
+    return [struct(x = x, y = y) for y in ys for x in xs]
+
+
+def tile_detections(detections, tile):
+    """ Offset detections of a tile to image coordinates, keeping those centred in the tile's own region """
+    offset = detections.bbox.new_tensor([tile.x.start, tile.y.start])
+    bbox = detections.bbox + offset.repeat(2)
+
+    centre = box.extents(bbox).centre
+    lower, upper = centre.new_tensor([tile.x.lower, tile.y.lower]), centre.new_tensor([tile.x.upper, tile.y.upper])
+    
+    inside = ((centre >= lower) & (centre < upper)).all(1)
+    return detections._extend(bbox = bbox)._index_select(inside.nonzero(as_tuple=False).squeeze(1))
+
+
+def evaluate_tiled(model, image, encoder, params=eval_defaults):
+    """ Evaluate a large image [H,W,C] split into tiles of params.image_size overlapping by params.overlap. 
+        Tiles are evaluated params.batch_size at a time, and merged across the seams with nms.
+    """
+    h, w, _ = image.shape
+    tiles = image_tiles((w, h), params.image_size, params.overlap)
+
+    detections = []
+    for i in range(0, len(tiles), params.batch_size):
+        batch = tiles[i:i + params.batch_size]
+        crops = [image[t.y.start:t.y.end, t.x.start:t.x.end] for t in batch]
+
+        result = evaluate_batch(model, crops, encoder, nms_params=params.nms_params, device=params.device)
+        detections += [tile_detections(d, t) for d, t in zip(result.detections, batch)]
+
+    return detection_table.nms(cat_tables(detections), params.nms_params)
+
+
+def evaluate_split(model, data, encoder, params=eval_defaults):
+    image_sizes = data.image_size.tolist() if 'image_size' in data \
+        else [(data.image.shape[2], data.image.shape[1])] * data.image.size(0)
+
+    images = [image[:h, :w] for image, (w, h) in zip(data.image, image_sizes)]
+    detections = [evaluate_tiled(model, image, encoder, params) for image in images]
+
+    # loss statistics are not computed for split images
+    return struct(detections = detections, statistics = None)
+
+
 def evaluate_full(model, data, encoder, params=eval_defaults):
     model.eval()
     with torch.no_grad():
-        result = evaluate_image(model, data.image, encoder, device=params.device, nms_params=params.nms_params)
+        if params.split:
+            return evaluate_split(model, data, encoder, params)
+
+        image_sizes = data.image_size.tolist() if 'image_size' in data else None
+        result = evaluate_batch(model, data.image, encoder, image_sizes=image_sizes, 
+            device=params.device, nms_params=params.nms_params)
 
-        prediction = map_tensors(result.prediction, lambda p: p.unsqueeze(0))
         target = tensors_to(data.target, device=params.device)
         encoding = tensors_to(data.encoding, device=params.device)
+        targets = split_table(target, data.lengths.tolist())
 
         input_size = (data.image.shape[2], data.image.shape[1])
-        loss = encoder.loss(input_size, [target], encoding, prediction)
+        loss = encoder.loss(input_size, targets, encoding, result.prediction)
         statistics = make_statistics(data, encoder, loss, result.prediction)
 
         return result._extend(statistics=statistics)
@@ -122,11 +249,13 @@ def evaluate_full(model, data, encoder, params=eval_defaults):
 def eval_test(model, encoder, params=eval_defaults):
     def f(data):
         result = evaluate_full(model, data, encoder, params)
-        return struct (
-            id = data.id,
-            target = data.target._map(Tensor.to, params.device),
+        targets = split_table(tensors_to(data.target, device='cpu'), data.lengths.tolist())
+
+        images = [struct(id = id, target = target, detections = tensors_to(detections, device='cpu'))
+            for id, target, detections in zip(data.id, targets, result.detections)]
 
-            detections = result.detections,
+        return struct (
+            images = images,
 
             # for summary of loss
             instances=data.lengths.sum().item(),
@@ -197,24 +326,47 @@ def threshold_count(confidence, thresholds):
 
 
 
-def count_target_classes(image_pairs, class_ids):
-    labels = torch.cat([i.target.label for i in image_pairs])
-    counts = labels.bincount(minlength = len(class_ids))
+iou_thresholds = list(range(30, 100, 5))
+
+def match_accumulator(classes):
+    return evaluate.MatchAccumulator(len(classes), [t / 100 for t in iou_thresholds])
+
+
+class TestAccumulator:
+    """ Folds test results into running state as they arrive (used in place of a list of results),
+        keeping only matches rather than full results.
+    """
+    def __init__(self, classes):
+        self.matches = match_accumulator(classes)
+
+    def append(self, result):
+        for image in result.images:
+            self.matches.add_image(image.detections, image.target)
+
+
+def accumulate_test(results, classes):
+    accumulator = TestAccumulator(classes)
+    for result in results:
+        accumulator.append(result)
+
+    return accumulator
 
-    return {k : count for k, count in zip(class_ids, counts)}
 
 def compute_AP(results, classes, conf_thresholds=None):
+    accumulator = match_accumulator(classes)
+    for r in results:
+        accumulator.add_image(r.detections, r.target)
+
+    return summarize_AP(accumulator, classes, conf_thresholds)
 
-    class_ids = pluck('id', classes)
-    iou_thresholds = list(range(30, 100, 5))
 
-    compute_mAP = evaluate.mAP_classes(results, num_classes = len(class_ids))
-    info = transpose_structs ([compute_mAP(t / 100) for t in iou_thresholds])
+def summarize_AP(accumulator, classes, conf_thresholds=None):
+    class_ids = pluck('id', classes)
 
-    info.classes = transpose_lists(info.classes)
+    info = accumulator.compute()
     assert len(info.classes) == len(class_ids)
 
-    target_counts = count_target_classes(results, class_ids)
+    target_counts = {k : count for k, count in zip(class_ids, accumulator.num_targets)}
 
     def summariseAP(ap, class_id = None):
         prs = {t : pr for t, pr in zip(iou_thresholds, ap)}
@@ -245,20 +397,19 @@ def compute_AP(results, classes, conf_thresholds=None):
 
 
 def summarize_test(name, results, classes, epoch, log, thresholds=None):
+    """ Summarize test results given either as a list or already folded into a TestAccumulator """
 
     class_names = {c.id : c.name for c in classes}
 
-    summary = compute_AP(results, classes, thresholds)
+    if not isinstance(results, TestAccumulator):
+        results = accumulate_test(results, classes)
+
+    summary = summarize_AP(results.matches, classes, thresholds)
     total, class_aps = summary.total, summary.classes
 
     mAP_strs ='mAP@30: {:.2f}, 50: {:.2f}, 75: {:.2f}'.format(total.mAP[30], total.mAP[50], total.mAP[75])
 
-    train_stats = filter_none(pluck('train_stats', results))
-
-    train_summary = summarize_train_stats(name, train_stats, classes, log) \
-        if len(train_stats) > 0 else ''
-
-    print(name + ' epoch: {} AP: {:.2f} mAP@[0.3-0.95]: [{}] {}'.format(epoch, total.AP * 100, mAP_strs, train_summary))
+    print(name + ' epoch: {} AP: {:.2f} mAP@[0.3-0.95]: [{}]'.format(epoch, total.AP * 100, mAP_strs))
 
     log.scalars(name, struct(AP = total.AP * 100.0, mAP30 = total.mAP[30] * 100.0, mAP50 = total.mAP[50] * 100.0, mAP75 = total.mAP[75] * 100.0))
 
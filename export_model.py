@@ -8,6 +8,7 @@ from tools.parameters import param, parse_args
 
 from tools.image import cv, transforms
 from main import load_model
+from models.fuse import optimise_inference
 
 import torch
 import torch.nn as nn
@@ -26,9 +27,15 @@ parameters = struct (
     size = param('1920x1080', help = "input resolution"),
 
     onnx_file = param(type='str',  required=True,   help = "output file"),
+    no_fuse = param(False, help = "export without folding batch norms into convolutions")
 )
 
-def export_onnx(model, size, filename):
+def export_onnx(model, size, filename, fuse=True):
+    if fuse:
+        example = torch.randn(1, 3, int(size[1]), int(size[0]))
+        model, info = optimise_inference(model.cpu(), example)
+        print("folded {} batch norms ({} remaining), max difference {:.2e}".format(info.folded, info.remaining, info.error))
+
     model_aug = nn.Sequential(transforms.Normalize(), model).cpu()
 
     dummy = torch.ByteTensor(1, int(size[1]), int(size[0]), 3)
@@ -72,3 +79,4 @@ if __name__=='__main__':
     print(model_args)
 
     size = args.size.split("x")
+    export_onnx(model, size, args.onnx_file, fuse=not args.no_fuse)
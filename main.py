@@ -9,6 +9,8 @@ import random
 import sys
 import traceback
 
+from functools import partial
+
 from torch import nn
 import torch.optim as optim
 
@@ -17,9 +19,11 @@ from json.decoder import JSONDecodeError
 from dataset.annotate import decode_dataset, split_tagged, tagged, decode_image, init_dataset, decode_object_map
 from dataset.imports import load_dataset
 
-from dataset.detection import least_recently_evaluated
+from dataset.detection import least_recently_evaluated, split_batch
+from dataset.augment import augment_batch
 
 from detection import models, box, detection_table, export
+from models.common import set_checkpointing
 
 import checkpoint
 
@@ -81,6 +85,10 @@ def initialise(config, dataset, args):
     model, encoder = models.create(model_args.model, model_args.dataset)
 
     set_bn_momentum(model, args.bn_momentum)
+    set_checkpointing(model, args.checkpoint)
+
+    # only used by retina, ttf targets are always encoded in the data loader workers
+    encoder.encode_workers = args.encode_workers
 
     best, current, resumed = checkpoint.load_checkpoint(model_path, model, model_args, args)
     model, epoch = current.model, current.epoch + 1
@@ -95,6 +103,10 @@ def initialise(config, dataset, args):
     device = torch.cuda.current_device()
     tests = args.tests.split(",")
 
+    scaler = evaluate.grad_scaler(device, args.amp)
+    if current.scaler and scaler.is_enabled():
+        scaler.load_state_dict(current.scaler)
+
     return struct(**locals())
 
 
@@ -127,21 +139,27 @@ def evaluate_review(env, image, nms_params, review):
         return make_detections(env, [])
 
     review = tensors_to(review, device=env.device)
-    ious = box.iou_matrix(detections.bbox, review.bbox * scale)
-    
-    ious[ious < nms_params.nms].fill_(-1)
-    scores = ious.mul(detections.confidence.unsqueeze(1))
+    pairs = box.overlapping_pairs(detections.bbox, review.bbox * scale, min_iou=nms_params.nms)
+
+    scores = pairs.iou * detections.confidence[pairs.i]
+    positive = (scores > 0).nonzero(as_tuple=True)[0]
+    order = positive[scores[positive].argsort(descending=True)]
 
-    review_inds = scores.max(0).values.argsort(descending=True)
+    # candidate detections of each reviewed box in order of decreasing score (iou * confidence),
+    # reviewed boxes are inserted in order of their best score
+    candidates = {}
+    for ind, i in zip(pairs.i[order].tolist(), pairs.j[order].tolist()):
+        candidates.setdefault(i, []).append(ind)
 
+    # greedy matching, each reviewed box takes its best scoring detection not already matched
     detections = table_list(detections)
-    for i in review_inds.tolist():
-        score, ind = scores[: , i].max(0)
-        
-        if score > 0:
-            detections[ind].match = i
+    matched = set()
 
-        scores[ind].fill_(0)
+    for i, inds in candidates.items():
+        ind = next((ind for ind in inds if ind not in matched), None)
+        if ind is not None:
+            detections[ind].match = i
+            matched.add(ind)
 
     return make_detections(env, detections)
 
@@ -199,28 +217,35 @@ def get_nms_params(args):
     return struct(
             nms = args.nms_threshold,
             threshold = args.class_threshold,
-            detections = args.max_detections)
+            detections = args.max_detections,
+            candidates = args.nms_candidates,
+            per_class = args.nms_per_class,
+            method = args.nms_method,
+            sigma = args.nms_sigma)
 
-def test_images(images, model, env, split=False, hook=None):
+def test_images(images, model, env, split=False, hook=None, results=None):
     eval_params = struct(
         overlap = env.args.overlap,
         split = split,
         image_size = (env.args.train_size, env.args.train_size),
-        batch_size = env.args.batch_size,
+        batch_size = env.args.test_batch_size,
         nms_params = get_nms_params(env.args),
         device = env.device,
         debug = env.debug
     )
 
     eval_test = evaluate.eval_test(model.eval(), env.encoder, eval_params)
-    return trainer.test(env.dataset.test_on(images, env.args, env.encoder), eval_test, hook=hook)
+    # split images are evaluated one at a time (tiles are batched instead)
+    loader = env.dataset.test_on(images, env.args, env.encoder, batch_size=1 if split else None)
+    return trainer.test(loader, eval_test, hook=hook, results=results)
 
 
 def run_testing(name, images, model, env, split=False, hook=None, thresholds=None):
 
   if len(images) > 0:
       print("{} {}:".format(name, env.epoch))
-      results = test_images(images, model, env, split=split, hook=hook)
+      results = test_images(images, model, env, split=split, hook=hook, 
+        results=evaluate.TestAccumulator(env.dataset.classes))
 
       return evaluate.summarize_test(name, results, env.dataset.classes, env.epoch, 
         log=EpochLogger(env.log, env.epoch), thresholds=thresholds)
@@ -240,7 +265,8 @@ def run_detections(model, env, images, hook=None, variation_window=None):
 
         mask = torch.ByteTensor([image.category in ['discard'] for image in images])
     
-        detections = [make_detections(env, table_list(result.detections)) for result in results]
+        detections = [make_detections(env, table_list(image.detections)) 
+            for result in results for image in result.images]
 
         if variation_window is not None:
             variation = torch.Tensor(len(images)).zero_()
@@ -391,10 +417,13 @@ def run_trainer(args, conn = None, env = None):
             n = max(1, min(int(t * len(train_images)), len(train_images)))
             train_images = train_images[:n]
 
+        augment = augment_batch(args, encoder, device=env.device) if args.augment == "batched" else None
+
         print("training {} on {} images:".format(env.epoch, len(train_images)))
         train_stats = trainer.train(env.dataset.sample_train_on(train_images, args, env.encoder),
             evaluate.eval_train(model.train(), env.encoder, env.debug, 
-            device=env.device), env.optimizer, hook=train_update)
+            device=env.device, augment=augment, amp=args.amp), env.optimizer, hook=train_update, scaler=env.scaler,
+            split=partial(split_batch, size=args.micro_batch) if args.micro_batch else None)
 
         evaluate.summarize_train("train", train_stats, env.dataset.classes, env.epoch, log=log)
 
@@ -412,7 +441,8 @@ def run_trainer(args, conn = None, env = None):
             env.best = struct(model = copy.deepcopy(model), score = score, thresholds = thresholds, epoch = env.epoch)
 
 
-        current = struct(state = model.state_dict(), epoch = env.epoch, thresholds = thresholds, score = score)
+        current = struct(state = model.state_dict(), epoch = env.epoch, thresholds = thresholds, score = score, 
+            scaler = env.scaler.state_dict())
         best = struct(state = env.best.model.state_dict(), epoch = env.best.epoch, thresholds = env.best.thresholds, score = env.best.score)
 
         # run_testing('test', env.dataset.test_images, model, env, hook=update('test'))
@@ -3,6 +3,7 @@ import torch.nn as nn
 import torch.nn.init as init
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.utils.checkpoint import checkpoint, set_checkpoint_early_stop
 
 from functools import partial
 from tools import Struct, shape
@@ -40,6 +41,21 @@ def map_modules(m, type, f):
 
     return m
 
+checkpoint_modes = ['none', 'levels', 'blocks']
+
+def set_checkpointing(m, mode):
+    """ Activation checkpointing, per pyramid level (backbone and decoder) or per residual block (decoder and heads) """
+    assert mode in checkpoint_modes, "unknown checkpoint mode: " + mode
+
+    for module in m.modules():
+        if isinstance(module, (Cascade, UpCascade)):
+            module.checkpoint = mode == 'levels'
+        elif isinstance(module, Residual):
+            module.checkpoint = mode == 'blocks'
+
+    return m
+
+
 def replace_batchnorms(m, num_groups):
     def convert(b):
         g = nn.GroupNorm(num_groups, b.num_features)
@@ -110,11 +126,46 @@ class Identity(nn.Module):
         return x
 
 
-def cascade(modules, input):
+def norm_buffers(module):
+    """ Running statistics of batch norms in a module """
+    return [b for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) for b in m.buffers()]
+
+
+def checkpointed(module, *inputs, enabled=True):
+    """ Run a module, if enabled (and training) activations are discarded and recomputed in the backward pass.
+        Batch norm running statistics are restored after recomputation, so they are only updated once. """
+    if enabled and module.training and torch.is_grad_enabled():
+        buffers = norm_buffers(module)
+        recompute = []
+
+        def run(*inputs):
+            if not recompute:
+                recompute.append(True)
+                return module(*inputs)
+
+            saved = [b.clone() for b in buffers]
+            outputs = module(*inputs)
+
+            with torch.no_grad():
+                for b, s in zip(buffers, saved):
+                    b.copy_(s)
+            return outputs
+
+        if len(buffers) == 0:
+            return checkpoint(module, *inputs, use_reentrant=False)
+
+        # recompute the whole module (not stopping early) so the statistics can be restored afterwards
+        with set_checkpoint_early_stop(False):
+            return checkpoint(run, *inputs, use_reentrant=False)
+
+    return module(*inputs)
+
+
+def cascade(modules, input, checkpoint=False):
     outputs = []
 
     for module in modules:
-        input = module(input)
+        input = checkpointed(module, input, enabled=checkpoint)
         outputs.append(input)
 
     return outputs
@@ -123,10 +174,11 @@ class Cascade(nn.Sequential):
     def __init__(self, *args, drop_initial=0):
         super(Cascade, self).__init__(*args)
         self.drop = drop_initial
+        self.checkpoint = False
 
 
     def forward(self, input):
-        out = cascade(self._modules.values(), input)
+        out = cascade(self._modules.values(), input, checkpoint=self.checkpoint)
         return out[self.drop:]
 
 
@@ -135,6 +187,7 @@ class UpCascade(nn.Module):
         super(UpCascade, self).__init__()
 
         self.decoders = nn.Sequential(*decoders)
+        self.checkpoint = False
 
     def forward(self, inputs):
 
@@ -144,7 +197,7 @@ class UpCascade(nn.Module):
         outputs = []
 
         for module, skip in zip(reverse(self.decoders._modules.values()), reverse(inputs)):
-            input = module(input, skip)
+            input = checkpointed(module, input, skip, enabled=self.checkpoint)
             outputs.append(input)
 
         return reverse(outputs)
@@ -187,9 +240,10 @@ class Residual(nn.Sequential):
     def __init__(self, module):
         super().__init__()
         self.module = module
+        self.checkpoint = False
 
     def forward(self, input):
-        output = self.module(input)
+        output = checkpointed(self.module, input, enabled=self.checkpoint)
         # assert (output.size(1) == input.size(1))
 
         return output + input
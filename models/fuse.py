@@ -0,0 +1,159 @@
+import copy
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from torchvision.models import resnet
+
+from models.common import Conv, Parallel, UpCascade, identity, set_checkpointing
+from tools import struct
+
+# Inference optimisation: folding batch norms into adjacent convolutions, removing training only modules
+# and (optionally) compiling the model. Conv (models.common) is pre-activation (norm -> activation -> conv),
+# its norm is folded into the conv preceding it where there is one, otherwise into its own conv if exact.
+
+
+def norm_scale(bn):
+    """ Batch norm (in eval mode) as a per channel scale and shift """
+    scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+    return scale, bn.bias - bn.running_mean * scale
+
+
+def fold_norm_before(bn, conv):
+    """ Fold a batch norm into the convolution following it """
+    scale, shift = norm_scale(bn)
+    fused = copy.deepcopy(conv)
+
+    weight = conv.weight * scale.view(1, -1, 1, 1)
+    bias = (conv.weight * shift.view(1, -1, 1, 1)).sum((1, 2, 3))
+
+    fused.weight = nn.Parameter(weight.detach())
+    fused.bias = nn.Parameter((bias if conv.bias is None else conv.bias + bias).detach())
+    return fused
+
+
+def can_fold_before(conv):
+    """ Only exact without padding (zero padding is applied after the norm) and without groups """
+    return conv.groups == 1 and all(p == 0 for p in conv.padding)
+
+
+def fold_sequential(seq):
+    """ Fold adjacent pairs in a Sequential: (Conv2d, BatchNorm2d), (Conv, BatchNorm2d)
+        and (Conv, Conv) where the pre-activation norm of the second is folded into the first """
+    keys = list(seq._modules.keys())
+    folded = 0
+
+    for k1, k2 in zip(keys, keys[1:]):
+        a, b = seq._modules[k1], seq._modules[k2]
+
+        if isinstance(b, nn.BatchNorm2d) and isinstance(a, nn.Conv2d):
+            seq._modules[k1], seq._modules[k2] = fuse_conv_bn_eval(a, b), nn.Identity()
+        elif isinstance(b, nn.BatchNorm2d) and isinstance(a, Conv):
+            a.conv, seq._modules[k2] = fuse_conv_bn_eval(a.conv, b), nn.Identity()
+        elif isinstance(a, Conv) and isinstance(b, Conv) and isinstance(b.norm, nn.BatchNorm2d):
+            a.conv, b.norm = fuse_conv_bn_eval(a.conv, b.norm), nn.Identity()
+        else:
+            continue
+
+        folded += 1
+    return folded
+
+
+def fold_resnet_block(block):
+    """ Fold the (conv, bn) pairs of torchvision BasicBlock and Bottleneck """
+    folded = 0
+    for i in [1, 2, 3]:
+        conv, bn = getattr(block, 'conv' + str(i), None), getattr(block, 'bn' + str(i), None)
+
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            setattr(block, 'conv' + str(i), fuse_conv_bn_eval(conv, bn))
+            setattr(block, 'bn' + str(i), nn.Identity())
+            folded += 1
+
+    return folded
+
+
+def fold_conv(conv):
+    """ Fold the norm of a Conv without activation into its own convolution, where exact """
+    if conv.activation is identity and isinstance(conv.norm, nn.BatchNorm2d) and can_fold_before(conv.conv):
+        conv.conv, conv.norm = fold_norm_before(conv.norm, conv.conv), nn.Identity()
+        return 1
+    return 0
+
+
+def strip_training(model):
+    """ Replace dropout with identity and disable activation checkpointing """
+    for module in model.modules():
+        for k, m in module._modules.items():
+            if isinstance(m, (nn.Dropout, nn.Dropout2d)):
+                module._modules[k] = nn.Identity()
+
+    return set_checkpointing(model, 'none')
+
+
+def fuse_model(model):
+    """ Copy of a model (in eval mode) with batch norms folded into adjacent convolutions,
+        returns the fused model and the number of batch norms folded and remaining """
+    model = strip_training(copy.deepcopy(model).eval())
+    folded = 0
+
+    # Sequential used only as a container of modules applied independently
+    containers = set(id(m.parallel) for m in model.modules() if isinstance(m, Parallel)) | \
+                 set(id(m.decoders) for m in model.modules() if isinstance(m, UpCascade))
+
+    with torch.no_grad():
+        for module in list(model.modules()):
+            if type(module) is nn.Sequential and id(module) not in containers:
+                folded += fold_sequential(module)
+            elif isinstance(module, (resnet.BasicBlock, resnet.Bottleneck)):
+                folded += fold_resnet_block(module)
+
+        for module in list(model.modules()):
+            if isinstance(module, Conv):
+                folded += fold_conv(module)
+
+    remaining = sum(1 for m in model.modules() if isinstance(m, nn.BatchNorm2d))
+    return model, struct(folded = folded, remaining = remaining)
+
+
+compile_methods = ['none', 'trace', 'script', 'compile']
+
+def compile_model(model, method='none', example=None):
+    """ Compile a model for inference, trace requires an example input """
+    assert method in compile_methods, "unknown compile method: " + method
+
+    if method == 'trace':
+        assert example is not None, "compile_model: tracing requires an example input"
+        return torch.jit.freeze(torch.jit.trace(model.eval(), example))
+    elif method == 'script':
+        return torch.jit.freeze(torch.jit.script(model.eval()))
+    elif method == 'compile':
+        return torch.compile(model.eval(), mode='max-autotune-no-cudagraphs')
+
+    return model
+
+
+def max_difference(model, optimised, input):
+    """ Largest absolute difference between outputs of two models, for checking optimised models are equivalent """
+    with torch.no_grad():
+        outputs, expected = optimised(input), model.eval()(input)
+
+    if torch.is_tensor(expected):
+        outputs, expected = [outputs], [expected]
+
+    return max((a.float() - b.float()).abs().max().item() for a, b in zip(outputs, expected))
+
+
+def optimise_inference(model, example, method='none', tolerance=1e-3):
+    """ Fold batch norms, remove training modules and compile,
+        checking the result is equivalent to the original model on the example input.
+        Returns the optimised model and struct(folded, remaining, error) """
+    fused, info = fuse_model(model)
+    optimised = compile_model(fused, method, example=example)
+
+    error = max_difference(model, optimised, example)
+    assert error < tolerance, "optimise_inference: optimised model differs by {} > {}".format(error, tolerance)
+
+    return optimised, info._extend(error = error)
+
@@ -0,0 +1,81 @@
+import torch
+import torch.nn as nn
+
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+from models.common import Cascade, Residual, Conv
+from models.fuse import fuse_model
+
+# Post training static quantization (int8, cpu) of the backbone and heads of a detection model,
+# using fx graph mode which handles residual additions and fuses conv/bn/relu where they are adjacent.
+# The feature pyramid decoder (upscaling, padding) is left in floating point.
+
+backends = ['x86', 'fbgemm', 'qnnpack']
+
+
+def is_subnet(m):
+    """ Residual subnet used for the network heads (models.feature_pyramid.residual_subnet) """
+    children = list(m.children())
+    return type(m) is nn.Sequential and len(children) > 2 \
+        and all(isinstance(c, Residual) for c in children[:-2]) and all(isinstance(c, Conv) for c in children[-2:])
+
+
+def quantizable(model):
+    """ Modules to quantize as (parent, name), backbones (outer most Cascade) and heads """
+    targets = []
+
+    def find(parent):
+        for name, m in parent.named_children():
+            if isinstance(m, Cascade) or is_subnet(m):
+                targets.append((parent, name))
+            else:
+                find(m)
+
+    find(model)
+    return targets
+
+
+def record_inputs(model, modules, example):
+    """ Inputs to each of the modules from one forward pass of the model """
+    inputs = {}
+
+    def hook(m, input, output):
+        inputs.setdefault(m, input)
+
+    handles = [m.register_forward_hook(hook) for m in modules]
+    with torch.no_grad():
+        model(example)
+
+    for handle in handles:
+        handle.remove()
+
+    return [inputs[m] for m in modules]
+
+
+def quantize_model(model, example, calibrate, backend='x86'):
+    """ Quantize the backbone and heads of a model (after folding batch norms),
+        example: a normalized input batch, used for tracing
+        calibrate: function running the prepared model on calibration images to collect activation statistics
+    """
+    assert backend in backends, "unknown quantization backend: " + backend
+    torch.backends.quantized.engine = backend
+
+    model, _ = fuse_model(model.cpu())
+    targets = quantizable(model)
+    assert len(targets) > 0, "quantize_model: no quantizable modules found"
+
+    modules = [getattr(parent, name) for parent, name in targets]
+    example_inputs = record_inputs(model, modules, example)
+
+    qconfig = get_default_qconfig_mapping(backend)
+    for (parent, name), module, inputs in zip(targets, modules, example_inputs):
+        setattr(parent, name, prepare_fx(module, qconfig, inputs))
+
+    with torch.no_grad():
+        calibrate(model)
+
+    for parent, name in targets:
+        setattr(parent, name, convert_fx(getattr(parent, name)))
+
+    return model.eval()
@@ -0,0 +1,29 @@
+from tools import struct
+from tools.parameters import param, parse_args, parse_choice
+
+from arguments import make_input_parameters
+from dataset.imports import load_dataset
+from dataset.detection import scale, resize, identity
+from dataset.packed import pack_dataset
+
+
+parameters = make_input_parameters()._merge(struct (
+    output = param(type='str',  required=True,   help = "output packed dataset file"),
+
+    scale  = param(1.0,     help='scale images (and boxes) by factor before packing'),
+    resize = param(None, type='float', help='resize short side of images to this dimension before packing')
+))
+
+
+if __name__=='__main__':
+    args = parse_args(parameters, "pack dataset", "pack dataset parameters")
+    args.input = parse_choice("input", parameters.input, args.input)
+
+    config, dataset = load_dataset(args)
+
+    transform = resize(args.resize) if args.resize is not None \
+        else scale(args.scale) if (args.scale != 1) \
+        else identity  
+
+    print("packing {} images to {}".format(len(dataset.images), args.output))
+    pack_dataset(args.output, config, dataset, transform=transform)
@@ -0,0 +1,96 @@
+import torch
+
+from tools import struct
+from tools.parameters import param, parse_args, parse_choice
+from tools.image.transforms import normalize_batch
+
+from arguments import make_input_parameters
+from checkpoint import load_model
+
+from dataset.imports import load_dataset
+from dataset.detection import load_image, scale, resize, identity
+
+from detection import detection_table
+from models.quantize import quantize_model, backends
+
+import evaluate
+from time import time
+
+
+parameters = make_input_parameters()._merge(struct (
+    model = param('',  required = True,     help = "model checkpoint to quantize"),
+    output = param(None, type='str', help = "output quantized model (torchscript)"),
+
+    backend = param('x86', help = "quantization backend: " + " | ".join(backends)),
+    calibration = param(32, help = "number of validation images used to calibrate activation ranges"),
+    images = param(None, type='int', help = "number of validation images to evaluate (default all)"),
+
+    scale  = param(1.0,     help='scale images (and boxes) by factor'),
+    resize = param(None, type='float', help='resize short side of images to this dimension'),
+
+    threshold = param(0.05, help = "detection threshold")
+))
+
+
+def load_images(dataset, images, transform):
+    loader = dataset.image_loader(struct(image_cache = 0))
+    return [transform(loader(image)) for image in images]
+
+
+def evaluate_model(model, encoder, images, nms_params):
+    """ Detections for each image (on the cpu) and the average time per image """
+    results = []
+
+    start = time()
+    for image in images:
+        detections = evaluate.evaluate_image(model, image.image, encoder, nms_params=nms_params, device='cpu').detections
+        results.append(struct(detections = detections, target = image.target))
+
+    return results, (time() - start) / max(1, len(images))
+
+
+def report(name, classes, results, elapsed):
+    total = evaluate.compute_AP(results, classes).total
+    print("{:10s} mAP@30: {:.2f}, 50: {:.2f}, 75: {:.2f}, AP: {:.2f}, {:.1f} ms per image".format(
+        name, total.mAP[30], total.mAP[50], total.mAP[75], total.AP, elapsed * 1000))
+
+
+if __name__=='__main__':
+    args = parse_args(parameters, "quantize model", "quantization parameters")
+    args.input = parse_choice("input", parameters.input, args.input)
+    print(args)
+
+    model, encoder, model_args = load_model(args.model)
+    model, encoder = model.cpu().eval(), encoder.to('cpu')
+
+    config, dataset = load_dataset(args)
+    classes = dataset.classes
+
+    transform = resize(args.resize) if args.resize is not None \
+        else scale(args.scale) if (args.scale != 1) \
+        else identity
+
+    validate = dataset.validate_images
+    assert len(validate) > 0, "no validation images in dataset"
+
+    calibration = load_images(dataset, validate[:args.calibration], transform)
+    images = load_images(dataset, validate[:args.images], transform)
+
+    nms_params = detection_table.nms_defaults._extend(threshold = args.threshold)
+
+    def calibrate(model):
+        for image in calibration:
+            model(normalize_batch(image.image.unsqueeze(0)).contiguous())
+
+    example = normalize_batch(calibration[0].image.unsqueeze(0)).contiguous()
+
+    print("calibrating on {} images...".format(len(calibration)))
+    quantized = quantize_model(model, example, calibrate, backend=args.backend)
+
+    print("evaluating on {} images:".format(len(images)))
+    report("float", classes, *evaluate_model(model, encoder, images, nms_params))
+    report("int8", classes, *evaluate_model(quantized, encoder, images, nms_params))
+
+    if args.output is not None:
+        torch.jit.save(torch.jit.trace(quantized, example), args.output)
+        print("saved quantized model to " + args.output)
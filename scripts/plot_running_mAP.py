@@ -27,7 +27,7 @@ def running_mAP(dataset, iou=[50], dx=0.1, sigma=5):
     eval_times = torch.arange(0, torch.max(times), dx)
    
     image_pairs =  filter_none([image_result(image) for image in dataset.history])
-    mAP = evaluate.mAP_smoothed(image_pairs, times) 
+    mAP = evaluate.mAP_smoothed(image_pairs, times, thresholds=[t/100.0 for t in iou]) 
 
     return eval_times.numpy(), { t : mAP(t/100.0, eval_times, sigma).numpy() for t in iou }
 
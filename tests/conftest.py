@@ -0,0 +1,10 @@
+import pytest
+from torchvision.models import resnet18
+
+import models.pretrained as pretrained
+
+
+@pytest.fixture
+def untrained_backbone(monkeypatch):
+    """ Same architecture as the pretrained backbone, without downloading weights """
+    monkeypatch.setitem(pretrained.models, 'resnet18', lambda: pretrained.resnet_layers(resnet18()))
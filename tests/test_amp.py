@@ -0,0 +1,94 @@
+import copy
+import math
+from functools import partial
+
+import pytest
+import torch
+
+from tools import struct, table
+
+import trainer
+import evaluate
+from dataset.detection import encode_target, collate_batch, split_batch
+
+from models.feature_pyramid import feature_map
+from detection.models.ttf.model import TTFNet, Encoder
+
+
+# One training step on the cpu for each mixed precision mode, with and without micro batches.
+
+pytestmark = pytest.mark.usefixtures('untrained_backbone')
+
+
+def create():
+    model = TTFNet(feature_map('resnet18', first=2, depth=5, features=16), features=16, num_classes=2)
+    encoder = Encoder(2, class_weights=[0.25, 0.25], params=struct(alpha=0.54, balance=1.))
+    return model, encoder
+
+
+def make_batch(encoder, n=4, size=64):
+    def image(i):
+        target = table(
+            bbox = torch.FloatTensor([[8, 8, 32, 40], [30, 20, 60, 50]])[:i % 2 + 1],
+            label = torch.LongTensor([0, 1])[:i % 2 + 1])
+
+        return struct(image = torch.randint(0, 255, (size, size, 3), dtype=torch.uint8), target = target, id = str(i))
+
+    return collate_batch([encode_target(encoder)(image(i)) for i in range(n)])
+
+
+def parameters(model):
+    return [p.detach().clone() for p in model.parameters()]
+
+def changed(before, model):
+    return any(not torch.equal(p, q) for p, q in zip(before, model.parameters()))
+
+
+def train_step(model, encoder, batch, amp, split=None):
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    scaler = evaluate.grad_scaler('cpu', amp)
+
+    eval = evaluate.eval_train(model, encoder, device='cpu', amp=amp)
+    results = trainer.train([batch], eval, optimizer, scaler=scaler, split=split)
+
+    assert len(results) == 1
+    return results[0], scaler
+
+
+@pytest.mark.parametrize("micro_batch", [None, 2])
+@pytest.mark.parametrize("amp", ['none', 'bf16', 'fp16'])
+def test_train_step(amp, micro_batch):
+    torch.manual_seed(0)
+    model, encoder = create()
+    batch = make_batch(encoder)
+
+    before = parameters(model)
+    initial_scale = evaluate.grad_scaler('cpu', amp).get_scale()
+
+    split = partial(split_batch, size=micro_batch) if micro_batch else None
+    stats, scaler = train_step(model, encoder, batch, amp, split=split)
+
+    assert stats.size == batch.image.size(0)
+    assert math.isfinite(stats.error) and all(math.isfinite(l) for l in stats.loss.values())
+
+    if scaler.is_enabled() and scaler.get_scale() < initial_scale:
+        # non-finite gradients in fp16, the step is skipped and the scale backed off
+        assert not changed(before, model)
+    else:
+        assert changed(before, model)
+
+
+def test_micro_batch_equivalent():
+    """ Accumulating gradients over micro batches gives the same step as the whole batch
+        (batch norms in eval mode, as their statistics otherwise depend on the micro batch) """
+    torch.manual_seed(0)
+    model, encoder = create()
+    batch = make_batch(encoder)
+
+    whole, micro = model.eval(), copy.deepcopy(model).eval()
+
+    train_step(whole, encoder, batch, 'none')
+    train_step(micro, encoder, batch, 'none', split=partial(split_batch, size=1))
+
+    for p, q in zip(whole.parameters(), micro.parameters()):
+        assert torch.allclose(p, q, atol=1e-5)
@@ -0,0 +1,40 @@
+import pytest
+import torch
+
+from models.common import set_checkpointing, norm_buffers
+from models.feature_pyramid import feature_map
+from detection.models.ttf.model import TTFNet
+
+
+# Activation checkpointing gives the same gradients and batch norm statistics as without.
+
+pytestmark = pytest.mark.usefixtures('untrained_backbone')
+
+
+def train_step(model, input):
+    output = model(input)
+    sum(o.sum() for o in output).backward()
+
+    grads = {k: p.grad.clone() for k, p in model.named_parameters() if p.grad is not None}
+    return grads, [b.clone() for b in norm_buffers(model)]
+
+
+@pytest.mark.parametrize("mode", ['levels', 'blocks'])
+def test_checkpointing(mode):
+    torch.manual_seed(0)
+    model = TTFNet(feature_map('resnet18', first=2, depth=5, features=16), features=16, num_classes=2).train()
+    state = {k: v.clone() for k, v in model.state_dict().items()}
+    input = torch.randn(2, 3, 64, 64)
+
+    grads, buffers = train_step(set_checkpointing(model, 'none'), input)
+
+    model.load_state_dict(state)
+    model.zero_grad()
+    checkpointed_grads, checkpointed_buffers = train_step(set_checkpointing(model, mode), input)
+
+    assert grads.keys() == checkpointed_grads.keys()
+    for k, grad in grads.items():
+        assert torch.allclose(grad, checkpointed_grads[k], atol=1e-5)
+
+    for a, b in zip(buffers, checkpointed_buffers):
+        assert torch.equal(a, b)
@@ -0,0 +1,87 @@
+import pytest
+
+import torch
+import torch.nn as nn
+
+from models.common import set_checkpointing
+from models.feature_pyramid import feature_pyramid, feature_map
+from models.fuse import fuse_model, compile_model, optimise_inference
+
+from detection.models.retina.model import RetinaNet
+from detection.models.ttf.model import TTFNet
+
+
+# Fused models (batch norms folded into convolutions) against the unfused models in eval mode,
+# for feature pyramid detectors exercising pre-activation Conv, Cascade and UpCascade.
+
+pytestmark = pytest.mark.usefixtures('untrained_backbone')
+
+
+def randomise_norms(model):
+    """ Non trivial batch norm statistics, so folding them is not a no-op """
+    with torch.no_grad():
+        for m in model.modules():
+            if isinstance(m, nn.BatchNorm2d):
+                m.running_mean.uniform_(-0.5, 0.5)
+                m.running_var.uniform_(0.5, 2)
+                m.weight.uniform_(0.5, 1.5)
+                m.bias.uniform_(-0.5, 0.5)
+    return model
+
+
+def retina():
+    return RetinaNet(feature_pyramid('resnet18', first=3, depth=6, features=32), num_boxes=9, num_classes=3)
+
+def ttf():
+    return TTFNet(feature_map('resnet18', first=2, depth=6, features=32), features=32, num_classes=3)
+
+
+def outputs(model, input):
+    with torch.no_grad():
+        return model(input)
+
+
+def assert_equivalent(model, fused, input):
+    for a, b in zip(outputs(fused, input), outputs(model, input)):
+        assert a.shape == b.shape
+        assert torch.allclose(a, b, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("create", [retina, ttf])
+def test_fuse_model(create):
+    torch.manual_seed(0)
+    model = randomise_norms(create()).eval()
+
+    fused, info = fuse_model(model)
+    assert info.folded > 0
+
+    assert_equivalent(model, fused, torch.randn(2, 3, 128, 96))
+
+
+@pytest.mark.parametrize("create", [retina, ttf])
+def test_fuse_checkpointed(create):
+    torch.manual_seed(0)
+    model = randomise_norms(set_checkpointing(create(), 'blocks')).eval()
+
+    fused, _ = fuse_model(model)
+    assert_equivalent(model, fused, torch.randn(1, 3, 96, 96))
+
+
+def test_fuse_trace():
+    torch.manual_seed(0)
+    model = randomise_norms(ttf()).eval()
+    input = torch.randn(1, 3, 96, 128)
+
+    fused, _ = fuse_model(model)
+    assert_equivalent(model, compile_model(fused, 'trace', example=input), input)
+
+
+def test_optimise_inference():
+    torch.manual_seed(0)
+    model = randomise_norms(retina()).eval()
+    input = torch.randn(1, 3, 96, 96)
+
+    optimised, info = optimise_inference(model, input)
+    assert info.folded > 0 and info.error < 1e-3
+
+    assert_equivalent(model, optimised, input)
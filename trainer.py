@@ -5,6 +5,9 @@ from torch import nn
 from tqdm import tqdm
 import gc
 
+from functools import reduce
+import operator
+
 
 def const(a):
     def f(*args):
@@ -13,32 +16,61 @@ def const(a):
 
 
 
-def run_progress(loader, hook, eval):
-    results = []
+def progress_total(loader, batch_size):
+    """ Number of images in a loader, loaders of variable sized batches (dataset.detection.SizeBatches) give num_images """
+    return loader.num_images if hasattr(loader, 'num_images') else len(loader) * batch_size
+
+
+def run_progress(loader, hook, eval, results=None):
+    """ Evaluate each batch, results are appended to a list or 
+        an accumulator (any object with an append method) """
+    results = [] if results is None else results
+    n = 0
 
     with tqdm() as bar:
-        for i, data in enumerate(loader):
+        for data in loader:
             result = eval(data)
 
-            if hook and hook((i + 1) * result.size, len(loader) * result.size): break
+            n += result.size
+            if bar.total is None:
+                bar.total = progress_total(loader, result.size)
+
+            if hook and hook(n, bar.total): break
 
             results.append(result)
             bar.update(result.size)
-            if bar.total is None:
-                bar.total = len(loader) * result.size
 
     return results
 
-def train(loader, eval, optimizer, hook = None):
+def train(loader, eval, optimizer, hook = None, scaler = None, split = None):
+    """ Train for one pass over the loader, if a (torch.amp) GradScaler is given the error is scaled
+        before backward and the optimizer step is skipped for non-finite gradients. 
+        If split is given each batch is split into micro batches, gradients are accumulated over the 
+        micro batches (the error of each normalised by the whole batch) with one optimizer step. """
+
+    def backward(error):
+        if scaler is not None:
+            scaler.scale(error).backward()
+        else:
+            error.backward()
 
     def update(data):
         optimizer.zero_grad()
 
-        result = eval(data)
-        result.error.backward()
-        optimizer.step()
+        statistics = []
+        for micro_batch in (split(data) if split else [data]):
+            result = eval(micro_batch)
+            backward(result.error)
+
+            statistics.append(result.statistics)
+
+        if scaler is not None:
+            scaler.step(optimizer)
+            scaler.update()
+        else:
+            optimizer.step()
 
-        return result.statistics
+        return reduce(operator.add, statistics)
         
     return run_progress(loader, hook, update)
 
@@ -53,8 +85,8 @@ def update_bn(loader, eval):
 
 
 
-def test(loader, eval, hook = None):
+def test(loader, eval, hook = None, results = None):
 
     with torch.no_grad():
-        return run_progress(loader, hook, eval)
+        return run_progress(loader, hook, eval, results=results)
 
@@ -239,11 +239,11 @@ if __name__ == '__main__':
     iter = None
 
     if args.test:
-        iter = dataset.test(args, encoder=None, collate=identity)
+        iter = dataset.test(args, encoder=None, collate=identity, batch_size=args.batch_size)
     elif args.validate:
-        iter = dataset.validate(args, encoder=None, collate=identity)
+        iter = dataset.validate(args, encoder=None, collate=identity, batch_size=args.batch_size)
     elif args.no_augment:
-        iter = dataset.test_on(dataset.train_images, args, encoder=None, collate=identity)
+        iter = dataset.test_on(dataset.train_images, args, encoder=None, collate=identity, batch_size=args.batch_size)
     else:
         iter = dataset.sample_train(args, encoder=None, collate=identity)
 